@@ -320,6 +320,8 @@ if args.gravity:
     rhs = mesh.construct_rhs()
     ksp = initialise_ksp(mat, solver='gmres')
     sol = solve(mesh, ksp, matrix=mat, rhs=rhs)
+    ksp.destroy()
+    mat.destroy() # not needed again, free it rather than pool it
     if comm.rank == 0:
         print("gravity solve time {} s".format(time() -t))
 
@@ -298,36 +298,35 @@ mesh2.update_properties(mesh.diffusivity[:], mesh.heat_sources[:])
 # introduce warmer lower BC
 mesh2.boundary_condition('minZ', bottomBC + 300.0, flux=False)
 
-H5_files = []
 steps = 10
-for step in range(steps):
-    t = time()
+interval = 10
+
+# output at the same times as 100 fixed timesteps
+# but let the timestep size adapt in between
+dt = mesh2.calculate_dt()
+output_times = [(step+1)*interval*dt for step in range(steps)]
 
-    # step 100 timesteps each iteration
-    interval = 10
-    dt = mesh2.calculate_dt()
-    T = mesh2.timestep(steps=interval, dt=dt)
+# every timestep is appended to one file
+mesh2.open_timeseries('geological_model_timeseries.h5')
 
-    H5_file = 'geological_model_step{:06d}.h5'.format((step+1)*interval)
-    H5_files.append(H5_file)
+def save_output(time_s, T):
+    t = time()
 
     # Calculate heat flow
     qz, qy, qx = mesh2.heatflux()
 
-    # Save to H5 file
-    mesh2.save_mesh_to_hdf5(H5_file)
-    mesh2.save_field_to_hdf5(H5_file,\
-                            layer_ID=layer_voxel.ravel(),\
-                            conductivity=mesh2.diffusivity[:],\
-                            heat_production=mesh2.heat_sources[:]*1e6,\
-                            temperature=mesh2.temperature[:]-273.14,\
-                            heat_flux=(qx+qy+qz)*1e3)
-    mesh2.save_vector_to_hdf5(H5_file,\
-                             heat_flux_vector=(qx*1e3,qy*1e3,qz*1e3),\
-                             heat_flux_vector_lateral=(qx*1e3,qy*1e3,np.zeros_like(qz)))
+    mesh2.save_timestep(layer_ID=layer_voxel.ravel(),\
+                        conductivity=mesh2.diffusivity[:],\
+                        heat_production=mesh2.heat_sources[:]*1e6,\
+                        temperature=T-273.14,\
+                        heat_flux=(qx+qy+qz)*1e3,\
+                        heat_flux_vector=(qx*1e3,qy*1e3,qz*1e3),\
+                        heat_flux_vector_lateral=(qx*1e3,qy*1e3,np.zeros_like(qz)))
 
     if comm.rank == 0:
-        print("processed timestep {} timestep size {} y in {:.2f} s".format((step+1)*interval, dt*3.17098e-8, time() - t))
+        print("saved time {} y, timestep size {} y in {:.2f} s".format(time_s*3.17098e-8, mesh2.dt*3.17098e-8, time() - t))
 
-if comm.rank == 0:
-    conduction.generateTimeseriesXdmf(*H5_files)
+mesh2.run_until(output_times[-1], rtol=1e-3, atol=1e-2, dt=dt,\
+                output_times=output_times, callback=save_output)
+
+mesh2.close_timeseries()
@@ -21,4 +21,4 @@ from .solver import *
 from .interpolation import RegularGridInterpolator
 # from .refinement import RefineGrids
 from .inversion import Inversion, InversionND
-from .mesh import MeshVariable
\ No newline at end of file
+from .mesh import MeshVariable, MeshVariableBundle
\ No newline at end of file
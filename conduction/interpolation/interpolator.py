@@ -17,7 +17,6 @@ along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 from scipy.interpolate import RegularGridInterpolator as RGI
-import itertools
 import numpy as np
 
 class RegularGridInterpolator(RGI):
@@ -27,51 +26,114 @@ class RegularGridInterpolator(RGI):
         super(RegularGridInterpolator, self).__init__(points, values, method, bounds_error, fill_value)
 
 
-    def adjoint(self, xi, dxi, method=None):
+    @property
+    def values(self):
+        return self._values
+    @values.setter
+    def values(self, value):
+        self._values = np.asarray(value)
+
+
+    def adjoint(self, xi, dxi, method=None, sparse=False):
         """
         Interpolation adjoint using the derivatives dxi at coordinates xi
+
+        Contributions from coordinates that share a grid node are summed.
+        Coordinates out of bounds do not contribute if fill_value is set.
+
         Parameters
         ----------
         xi : ndarray of shape (..., ndim)
             The coordinates to sample the gridded data at
-        dxi : ndarray of shape (..., ndim)
+        dxi : ndarray of shape (...)
              The derivatives at the coordinates xi
         method : str
                 The method of interplolation to perform.
                 Supports either 'linear' or 'nearest'
+        sparse : bool
+                Return (indices, values) of the nonzero grid nodes
+                (flat indices into values) instead of a full grid array
         """
         if method is None:
             method = self.method
-            
-        self.derivative = dxi
-        indices, norm_distances, out_of_bounds = self._find_indices(xi.T)
+
+        xi = np.asarray(xi, dtype=np.float64).reshape(-1, len(self.grid))
+        indices, norm_distances, out_of_bounds = self._find_grid_indices(xi)
+
         if method == "linear":
-            result = self._evaluate_linear_adjoint(indices, norm_distances, out_of_bounds)
+            idx, weights = self._linear_weights(indices, norm_distances)
         elif method == "nearest":
-            result = self._evaluate_nearest_adjoint(indices, norm_distances, out_of_bounds)
-        return result
-
-    def _evaluate_linear_adjoint(self, indices, norm_distances, out_of_bounds):
-        # slice for broadcasting over trailing dimensions in self.values
-        vslice = (slice(None),) + (None,)*(self.values.ndim - len(indices))
-        # find relevant values
-        # each i and i+1 represents a edge
-        edges = itertools.product(*[[i, i + 1] for i in indices])
-        values = np.zeros_like(self.values)
-        for edge_indices in edges:
-            weight = 1.
-            for ei, i, yi in zip(edge_indices, indices, norm_distances):
-                weight *= np.where(ei == i, 1 - yi, yi)
-            values[edge_indices] += np.asarray(self.derivative) * weight[vslice]
-        return values
-
-    def _evaluate_nearest_adjoint(self, indices, norm_distances, out_of_bounds):
-        idx_res = []
-        values = np.zeros_like(self.values)
-        for i, yi in zip(indices, norm_distances):
-            idx_res.append(np.where(yi <= 0.5, i, i + 1))
-        values[idx_res] = self.derivative
-        return values
+            idx, weights = self._nearest_weights(indices, norm_distances)
+        else:
+            raise ValueError("Method '{}' is not defined".format(method))
+
+        return self._scatter_adjoint(idx, weights, dxi, out_of_bounds, sparse)
+
+    def _find_grid_indices(self, xi):
+        """
+        Lower grid indices, normalised distances and out of bounds mask
+        for coordinates xi of shape (n, ndim) as arrays of shape (ndim, n)
+        """
+        result = self._find_indices(xi.T)
+        if len(result) == 3:
+            indices, norm_distances, out_of_bounds = result
+        else:
+            # newer scipy computes out of bounds separately
+            indices, norm_distances = result
+            out_of_bounds = self._find_out_of_bounds(xi.T)
+        return np.asarray(indices), np.asarray(norm_distances), np.asarray(out_of_bounds)
+
+    def _linear_weights(self, indices, norm_distances):
+        """
+        Flat grid indices and weights of every hypercube corner, shape (n, 2**ndim)
+        """
+        ndim = len(self.grid)
+        shape = self.values.shape[:ndim]
+
+        # corner c takes the upper node along dimension i if bit i is set
+        bits = (np.arange(2**ndim)[:,None] >> np.arange(ndim)[None,:]) & 1
+        corner_indices = indices[:,None,:] + bits.T[:,:,None]
+        weights = np.where(bits.T[:,:,None], norm_distances[:,None,:], 1.0 - norm_distances[:,None,:])
+
+        idx = np.ravel_multi_index(tuple(corner_indices), shape, mode='clip')
+        return idx.T, weights.prod(axis=0).T
+
+    def _nearest_weights(self, indices, norm_distances):
+        """
+        Flat grid indices and unit weights of the nearest node, shape (n, 1)
+        """
+        shape = self.values.shape[:len(self.grid)]
+        nearest = np.where(norm_distances <= 0.5, indices, indices + 1)
+        idx = np.ravel_multi_index(tuple(nearest), shape, mode='clip')
+        return idx[:,None], np.ones((idx.size, 1))
+
+    def _scatter_adjoint(self, idx, weights, dxi, out_of_bounds, sparse):
+        ndim = len(self.grid)
+        shape = self.values.shape[:ndim]
+        trailing = self.values.shape[ndim:]
+        size = int(np.prod(shape))
+
+        dxi = np.asarray(dxi, dtype=np.float64).reshape(idx.shape[0], -1)
+        if self.fill_value is not None:
+            inbounds = ~out_of_bounds
+            idx, weights, dxi = idx[inbounds], weights[inbounds], dxi[inbounds]
+
+        if sparse:
+            nodes, inverse = np.unique(idx, return_inverse=True)
+            inverse = inverse.ravel()
+            nbins = nodes.size
+        else:
+            inverse = idx.ravel()
+            nbins = size
+
+        values = np.empty((nbins, dxi.shape[1]))
+        for j in range(dxi.shape[1]):
+            w = (weights*dxi[:,j,None]).ravel()
+            values[:,j] = np.bincount(inverse, weights=w, minlength=nbins)
+
+        if sparse:
+            return nodes, values.reshape((nbins,) + trailing)
+        return values.reshape(shape + trailing)
 
 
 class KDTreeInterpolator(object):
@@ -79,6 +141,12 @@ class KDTreeInterpolator(object):
     This object implements scipy.spatial.cKDTree for fast nearest-neighbour lookup
     and interpolates the coordinate based on the next closes value
 
+    Linear interpolation uses barycentric weights on a Delaunay
+    triangulation of the points, which is only built when it is needed.
+    The indices and weights of the last coordinates passed for each
+    method are cached, so repeated calls with fixed coordinates
+    (e.g. observations) skip the tree query.
+
     Arguments
     ---------
      points        : ndarray(n,dim) arbitrary set of points to interpolate over
@@ -110,40 +178,74 @@ class KDTreeInterpolator(object):
         self.bbox = bbox
         
         self._values = np.ravel(values)
-        
-    def __call__(self, xi, *args, **kwargs):
-        idx, d, bmask = self._find_indices(xi)
+
+        # Delaunay triangulation for linear interpolation
+        self._tri = None
+
+        # method : (xi, indices, weights, bounds)
+        self._cache = {}
+
+    def __call__(self, xi, method="nearest", *args, **kwargs):
+        idx, w, bmask = self._get_weights(xi, method)
         
         if self.bounds_error and bmask.any():
             bidx = np.nonzero(bmask)[0]
             raise ValueError("Coordinates in xi are out of bounds in:\n {}".format(bidx))
         
-        vi = self.values[idx]
+        if w is None:
+            vi = self.values[idx]
+        else:
+            vi = (self.values[idx]*w).sum(axis=1)
+
         if not self.bounds_error and self.fill_value is not None:
             vi[bmask] = self.fill_value
         
         return vi
     
-    def adjoint(self, xi, dxi, *args, **kwargs):
-        idx, d, bmask = self._find_indices(xi)
+    def adjoint(self, xi, dxi, method="nearest", *args, **kwargs):
+        """
+        Interpolation adjoint using the derivatives dxi at coordinates xi
+        Contributions of coordinates that share a point are summed.
+        """
+        idx, w, bmask = self._get_weights(xi, method)
         
         if self.bounds_error and bmask.any():
             bidx = np.nonzero(bmask)[0]
             raise ValueError("Coordinates in xi are out of bounds in:\n {}".format(bidx))
-        
-        dv = np.zeros_like(self.values)
 
         # remove indices that are out of bounds
-        idx_inbounds = idx[~bmask]
-        
-        ux = np.unique(idx_inbounds)
-        for u in ux:
-            dv[u] = dxi[idx==u].sum()
+        inbounds = ~bmask
+        dxi = np.ravel(dxi)[inbounds]
+        idx = idx[inbounds]
+
+        if w is None:
+            dv = np.bincount(idx, weights=dxi, minlength=self.npoints)
+        else:
+            dw = w[inbounds]*dxi[:,None]
+            dv = np.bincount(idx.ravel(), weights=dw.ravel(), minlength=self.npoints)
 
-        if not self.bounds_error and self.fill_value is not None:
-            dv[idx][bmask] = self.fill_value
-            
         return dv
+
+    def _get_weights(self, xi, method):
+        """
+        Indices and weights to interpolate values at xi (cached)
+        """
+        cache = self._cache.get(method)
+        if cache is not None:
+            cxi, idx, w, bounds = cache
+            if cxi is xi or (cxi.shape == np.shape(xi) and np.array_equal(cxi, xi)):
+                return idx, w, bounds
+
+        if method == "nearest":
+            idx, d, bounds = self._find_indices(xi)
+            w = None
+        elif method == "linear":
+            idx, w, bounds = self._find_simplices(xi)
+        else:
+            raise ValueError("Method '{}' is not defined".format(method))
+
+        self._cache[method] = (np.array(xi, copy=True), idx, w, bounds)
+        return idx, w, bounds
     
     def _find_indices(self, xi):
         d, idx = self.tree.query(xi)
@@ -158,6 +260,30 @@ class KDTreeInterpolator(object):
             
         return idx, d, bounds
 
+    def _find_simplices(self, xi):
+        """
+        Vertices and barycentric weights of the simplex enclosing xi
+        """
+        if self._tri is None:
+            from scipy.spatial import Delaunay
+            self._tri = Delaunay(self.tree.data)
+
+        tri = self._tri
+        ndim = self.ndim
+
+        simplex = tri.find_simplex(xi)
+        bounds = simplex < 0
+        simplex[bounds] = 0
+
+        # barycentric coordinates from the affine transform of each simplex
+        T = tri.transform[simplex]
+        b = np.einsum('ijk,ik->ij', T[:,:ndim,:], xi - T[:,ndim,:])
+        w = np.column_stack([b, 1.0 - b.sum(axis=1)])
+        w[bounds] = 0.0
+
+        idx = tri.simplices[simplex]
+        return idx, w, bounds
+
 
     @property
     def values(self):
@@ -18,6 +18,28 @@ along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
 
+def hofmeister1999(k0, T, a=0.25, c=0.0):
+    """
+    Temperature-dependent conductivity law of Hofmeister (1999)
+    """
+    return k0*(298.0/T)**a + c*T**3
+
+def hofmeister1999_ad(T, k0, a=0.25, c=0.0):
+    """
+    Derivatives of hofmeister1999
+
+    Returns
+    -------
+     dkdT  : derivative w.r.t. temperature
+     dkdk0 : derivative w.r.t. reference conductivity
+     dkda  : derivative w.r.t. exponent a
+    """
+    dkdk0 = (298.0/T)**a
+    dkdT = -a*k0/T*dkdk0 + 3.0*c*T**2
+    dkda = np.log(298.0/T)*k0*dkdk0
+    return dkdT, dkdk0, dkda
+
+
 def linear(x, self, bc='Z'):
     """
     N-dimensional linear model with flux lower BC
@@ -119,10 +141,10 @@ def linear_ad(x, self, bc='Z'):
     dH += -db
     dz = self.grid_delta[-1]
     lowerBC_mask = self.mesh.bc["min"+bc]["mask"]
-    dq0 += np.sum(-db[lowerBC_mask]/dz/inv.ghost_weights[lowerBC_mask])
+    dq0 += np.sum(-db[lowerBC_mask]/dz/self.ghost_weights[lowerBC_mask])
     
     # pack to lists
-    dk_list, dH_list = inv.map_ad(dk, dH)
+    dk_list, dH_list = self.map_ad(dk, dH)
     dk_list += dcdk_list
     dH_list += dcdH_list
     dq0 += dcdq0
@@ -147,31 +169,22 @@ def nonlinear(x, self, bc='Z'):
      cost : scalar
 
     """
-    def hofmeister1999(k0, T, a=0.25, c=0.0):
-        return k0*(298.0/T)**a + c*T**3
-
     k_list, H_list, a_list = np.array_split(x[:-1], 3)
     q0 = x[-1]
     
     # map to mesh
     k0, H, a = self.map(k_list, H_list, a_list)
-    k = k0.copy()
     
     self.mesh.update_properties(k0, H)
     self.mesh.boundary_condition("max"+bc, 298.0, flux=False)
     self.mesh.boundary_condition("min"+bc, q0, flux=True)
     rhs = self.mesh.construct_rhs()
     
-    error = 10.
-    tolerance = 1e-5
-    i = 0
-    while error > tolerance:
-        k_last = k.copy()
-        self.mesh.diffusivity[:] = k
-        T = self.linear_solve(rhs=rhs) # solve
-        k = hofmeister1999(k0, T, a)
-        error = np.absolute(k - k_last).max()
-        i += 1
+    # Newton solve
+    k_fn = lambda T: hofmeister1999(k0, T, a)
+    dk_dT_fn = lambda T: hofmeister1999_ad(T, k0, a)[0]
+    T = self.mesh.solve_nonlinear(k_fn, dk_dT_fn, rhs=rhs)
+    k = self.mesh.diffusivity[:]
         
     q = self.heatflux(T, k)
     delT = self.gradient(T)
@@ -197,40 +210,28 @@ def nonlinear_ad(x, self, bc='Z'):
      cost : scalar
      grad : [dk_list, dH_list, da_list, dq0]
     """
-    def hofmeister1999(k0, T, a=0.25, c=0.0):
-        return k0*(298.0/T)**a + c*T**3
     k_list, H_list, a_list = np.array_split(x[:-1], 3)
     q0 = x[-1]
     
     # map to mesh
     k0, H, a = self.map(k_list, H_list, a_list)
-    k = [k0.copy()]
-    T = [None]
     
     self.mesh.update_properties(k0, H)
     self.mesh.boundary_condition("max"+bc, 298.0, flux=False)
     self.mesh.boundary_condition("min"+bc, q0, flux=True)
     rhs = self.mesh.construct_rhs()
     
-    error = 10.
-    tolerance = 1e-5
-    i = 0
-    self.mesh.temperature._gdata.set(0.)
-    while error > tolerance:
-        self.mesh.diffusivity[:] = k[i]
-        # solve
-        Ti = self.linear_solve(rhs=rhs)
-        ki = hofmeister1999(k0, Ti, a)
-        T.append(Ti.copy())
-        k.append(ki.copy())
-        error = np.absolute(k[-1] - k[-2]).max()
-        i += 1
-
-    q = self.heatflux(T[-1], k[-1])
-    delT = self.gradient(T[-1])
+    # Newton solve
+    k_fn = lambda T: hofmeister1999(k0, T, a)
+    dk_dT_fn = lambda T: hofmeister1999_ad(T, k0, a)[0]
+    T = self.mesh.solve_nonlinear(k_fn, dk_dT_fn, rhs=rhs)
+    k = self.mesh.diffusivity[:]
+
+    q = self.heatflux(T, k)
+    delT = self.gradient(T)
     
     cost = 0.0
-    cost += self.objective_routine(q=q[0], T=T[-1], delT=delT[0]) # observations
+    cost += self.objective_routine(q=q[0], T=T, delT=delT[0]) # observations
     cost += self.objective_routine(k=k_list, H=H_list, a=a_list, q0=q0) # priors
     
     ## AD ##
@@ -247,7 +248,7 @@ def nonlinear_ad(x, self, bc='Z'):
     dcda_list = self.objective_routine_ad(a=a_list)
     dcdq0 = self.objective_routine_ad(q0=q0)
     # observations
-    dT += self.objective_routine_ad(T=T[-1])
+    dT += self.objective_routine_ad(T=T)
 
     dq = np.zeros_like(q)
     dq[0] = self.objective_routine_ad(q=q[0])
@@ -256,41 +257,30 @@ def nonlinear_ad(x, self, bc='Z'):
     ddelT[0] = self.objective_routine_ad(delT=delT[0])
     
 
-    dTd = self.gradient_ad(ddelT, T[-1])
+    dTd = self.gradient_ad(ddelT, T)
     dT += dTd
     
-    dTq, dkq = self.heatflux_ad(dq, q, T[-1], k[-1])
+    dTq, dkq = self.heatflux_ad(dq, q, T, k)
     dT += dTq
     dk += dkq
     
 
-    # solve
-    for j in range(i):
-        dkda = np.log(298.0/T[-1-j])*k0*(298.0/T[-1-j])**a
-        dkdk0 = (298.0/T[-1-j])**a
-        dkdT = -a*k0/T[-1-j]*(298.0/T[-1-j])**a
-        
-        dk0 += dkdk0*dk
-        dT  += dkdT*dk
-        da  += dkda*dk
-        print dT.min(), dT.max(), dk.min(), dk.max()
-        
-        dk.fill(0.0)
-        
-        self.mesh.diffusivity[:] = k[-1-j]
-        dA, db = self.linear_solve_ad(T[-1-j], dT)
-        dk += dA
-        dH += -db
-        dz = self.grid_delta[-1]
-        lowerBC_mask = self.mesh.bc["min"+bc]["mask"]
-        dq0 += np.sum(-db[lowerBC_mask]/dz/inv.ghost_weights[lowerBC_mask])
-        
-        dT.fill(0.0)
-        
-    dk0 += dk
+    # solve (implicit function theorem at the converged temperature)
+    dkdT, dkdk0, dkda = hofmeister1999_ad(T, k0, a)
+    dT += dkdT*dk
+
+    dA, db = self.mesh.solve_nonlinear_ad(T, dT, k_fn, dk_dT_fn)
+    dk += dA
+    dH += -db
+    dz = self.grid_delta[-1]
+    lowerBC_mask = self.mesh.bc["min"+bc]["mask"]
+    dq0 += np.sum(-db[lowerBC_mask]/dz/self.ghost_weights[lowerBC_mask])
+
+    dk0 += dkdk0*dk
+    da  += dkda*dk
         
     # pack to lists
-    dk_list, dH_list, da_list = inv.map_ad(dk0, dH, da)
+    dk_list, dH_list, da_list = self.map_ad(dk0, dH, da)
     dk_list += dcdk_list
     dH_list += dcdH_list
     da_list += dcda_list
@@ -306,23 +296,18 @@ def velocity_nonlinear(x, self, bc='Z'):
     
     # map to mesh
     k0, H, a, psi, B = self.map(k_list, H_list, a_list, psi_list, B_list)
-    k = k0.copy()
     
     self.mesh.update_properties(k0, H)
     self.mesh.boundary_condition("max"+bc, 298.0, flux=False)
     self.mesh.boundary_condition("min"+bc, q0, flux=True)
     rhs = self.mesh.construct_rhs()
     
-    error = 10.
-    tolerance = 1e-5
-    i = 0
-    while error > tolerance:
-        k_last = k.copy()
-        self.mesh.diffusivity[:] = k
-        T = self.linear_solve(rhs=rhs) # solve
-        k = hofmeister1999(k0, T, a)
-        error = np.absolute(k - k_last).max()
-        i += 1
+    # Newton solve
+    k_fn = lambda T: hofmeister1999(k0, T, a)
+    dk_dT_fn = lambda T: hofmeister1999_ad(T, k0, a)[0]
+    T = self.mesh.solve_nonlinear(k_fn, dk_dT_fn, rhs=rhs)
+    k = self.mesh.diffusivity[:]
+    i = self.mesh.nonlinear_iterations
     print("{} iterations".format(i))
         
     q = self.heatflux(T, k)
@@ -348,31 +333,21 @@ def velocity_nonlinear_ad(x, self, bc='Z'):
     
     # map to mesh
     k0, H, a, psi, B = self.map(k_list, H_list, a_list, psi_list, B_list)
-    k = [k0.copy()]
-    T = [None]
     
     self.mesh.update_properties(k0, H)
     self.mesh.boundary_condition("max"+bc, 298.0, flux=False)
     self.mesh.boundary_condition("min"+bc, q0, flux=True)
     rhs = self.mesh.construct_rhs()
     
-    error = 10.
-    tolerance = 1e-5
-    i = 0
-    self.mesh.temperature._gdata.set(0.)
-    while error > tolerance:
-        self.mesh.diffusivity[:] = k[i]
-        # solve
-        Ti = self.linear_solve(rhs=rhs)
-        ki = hofmeister1999(k0, Ti, a)
-        T.append(Ti.copy())
-        k.append(ki.copy())
-        error = np.absolute(k[-1] - k[-2]).max()
-        i += 1
-    print("{} iterations".format(i))
+    # Newton solve
+    k_fn = lambda T: hofmeister1999(k0, T, a)
+    dk_dT_fn = lambda T: hofmeister1999_ad(T, k0, a)[0]
+    T = self.mesh.solve_nonlinear(k_fn, dk_dT_fn, rhs=rhs)
+    k = self.mesh.diffusivity[:]
+    print("{} iterations".format(self.mesh.nonlinear_iterations))
 
-    q = self.heatflux(T[-1], k[-1])
-    delT = self.gradient(T[-1])
+    q = self.heatflux(T, k)
+    delT = self.gradient(T)
     rho, Vsp, dVspdT = self.lookup_velocity()
     P = rho*np.abs(self.mesh.coords[:,-1])*9.806*1e-5
     
@@ -381,7 +356,7 @@ def velocity_nonlinear_ad(x, self, bc='Z'):
     Vs = Vsp * (1.0 - 0.5*(1.0/np.tan(np.pi*0.26/2.0))*Q)
     
     cost = 0.0
-    cost += self.objective_routine(q=q[0], T=T[-1], delT=delT[0], Vs=Vs) # observations
+    cost += self.objective_routine(q=q[0], T=T, delT=delT[0], Vs=Vs) # observations
     cost += self.objective_routine(k=k_list, H=H_list, a=a_list, q0=q0) # priors
     
     ## AD ##
@@ -403,7 +378,7 @@ def velocity_nonlinear_ad(x, self, bc='Z'):
     dcdB_list = self.objective_routine_ad(B=B_list)
     dcdq0 = self.objective_routine_ad(q0=q0)
     # observations
-    dT += self.objective_routine_ad(T=T[-1])
+    dT += self.objective_routine_ad(T=T)
 
     dq = np.zeros_like(q)
     dq[0] = self.objective_routine_ad(q=q[0])
@@ -422,40 +397,30 @@ def velocity_nonlinear_ad(x, self, bc='Z'):
     dB += dQdB*dQ
     
 
-    dTd = self.gradient_ad(ddelT, T[-1])
+    dTd = self.gradient_ad(ddelT, T)
     dT += dTd
     
-    dTq, dkq = self.heatflux_ad(dq, q, T[-1], k[-1])
+    dTq, dkq = self.heatflux_ad(dq, q, T, k)
     dT += dTq
     dk += dkq
     
 
-    # solve
-    for j in xrange(i):
-        dkdT, dkdk0, dkda = hofmeister1999_ad(T[-1-j], k0, a)
-        
-        dk0 += dkdk0*dk
-        dT  += dkdT*dk
-        da  += dkda*dk
-        
-        dk.fill(0.0)
-        
+    # solve (implicit function theorem at the converged temperature)
+    dkdT, dkdk0, dkda = hofmeister1999_ad(T, k0, a)
+    dT += dkdT*dk
 
-        self.mesh.diffusivity[:] = k[-1-j]
-        dA, db = self.linear_solve_ad(T[-1-j], dT)
+    dA, db = self.mesh.solve_nonlinear_ad(T, dT, k_fn, dk_dT_fn)
+    dk += dA
+    dH += -db
+    dz = self.grid_delta[-1]
+    lowerBC_mask = self.mesh.bc["min"+bc]["mask"]
+    dq0 += np.sum(-db[lowerBC_mask]/dz/self.ghost_weights[lowerBC_mask])
 
-        dk += dA
-        dH += -db
-        dz = self.grid_delta[-1]
-        lowerBC_mask = self.mesh.bc["min"+bc]["mask"]
-        dq0 += np.sum(-db[lowerBC_mask]/dz/inv.ghost_weights[lowerBC_mask])
-        
-        dT.fill(0.0)
-        
-    dk0 += dk
+    dk0 += dkdk0*dk
+    da  += dkda*dk
         
     # pack to lists
-    dk_list, dH_list, da_list, dpsi_list, dB_list = inv.map_ad(dk0, dH, da, dpsi, dB)
+    dk_list, dH_list, da_list, dpsi_list, dB_list = self.map_ad(dk0, dH, da, dpsi, dB)
     dk_list += dcdk_list
     dH_list += dcdH_list
     da_list += dcda_list
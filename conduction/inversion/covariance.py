@@ -57,9 +57,6 @@ def create_covariance_matrix(sigma, coords, max_dist, func, *args, **kwargs):
      func should always receive sigma and distance as first
      two inputs
     """
-    from scipy.spatial import cKDTree
-    from petsc4py import PETSc
-
     ncov = len(sigma)
     nn = np.hstack(sigma).size
     if ncov < nn:
@@ -67,66 +64,35 @@ def create_covariance_matrix(sigma, coords, max_dist, func, *args, **kwargs):
         if len(coords) != ncov or len(max_dist) != ncov:
             raise ValueError("sigma, coords, max_dist must be the same dimensions")
 
-        # find the size of each list
-        size = np.zeros(ncov, dtype=PETSc.IntType)
-        nnz = []
-        for j in range(0,ncov):
-            size[j] = len(sigma[j])
-
-            dist = np.linalg.norm(coords[j] - coords[j].mean(axis=0), axis=1)
-            nnz_j = int(1.5*(dist <= max(max_dist[j])).sum())
-            nnz.append( np.ones(size[j], dtype=PETSc.IntType)*nnz_j )
-
-        nnz = np.clip(np.hstack(nnz), 1, 99999)
-
+        size = [len(sigma[j]) for j in range(ncov)]
+        max_dist = [np.ones(size[j])*max_dist[j] for j in range(ncov)]
 
     elif ncov == nn:
         ncov = 1
         size = [len(sigma)]
 
-        # find distance between coords and centroid
-        dist = np.linalg.norm(coords - coords.mean(axis=0), axis=1)
-
         # pad these within a list object
         coords = [coords]
-        max_dist = [np.ones_like(sigma)*max_dist]
+        max_dist = [np.ones_like(sigma, dtype=np.float64)*max_dist]
         sigma = [sigma]
 
-        nnz = int(1.5*(dist <= max(max_dist)).sum())
-
-
-    # set up matrix
-    mat = PETSc.Mat().create(comm)
-    mat.setType('aij')
-    mat.setSizes((nn, nn))
-    mat.setPreallocationNNZ((nnz,1))
-    mat.setOption(PETSc.Mat.Option.NEW_NONZERO_ALLOCATION_ERR, 0)
-    mat.setFromOptions()
-    mat.assemblyBegin()
+    # rows owned by this processor
+    rstart, rend = _owned_range(nn)
 
     colsum = np.cumsum(np.insert(size, 0, 0))
 
-    row = 0
+    rows, cols, vals = [], [], []
     for j in range(0, ncov):
-        icoord = coords[j]
-        imax_dist = max_dist[j]
-        isigma = sigma[j]
-
-        # set up KDTree and max_dist to query
-        tree = cKDTree(icoord)
-
-        for i in range(0, size[j]):
-            idx = tree.query_ball_point(icoord[i], imax_dist[i])
-            dist = np.linalg.norm(icoord[i] - icoord[idx], axis=1)
-            
-            col = np.array(idx + colsum[j], dtype=PETSc.IntType)
-            val = func(isigma[idx], dist, *args, **kwargs)
-            mat.setValues(row, col, val)
-            
-            row += 1
-
-    mat.assemblyEnd()
-    return mat
+        # owned rows within this block
+        lrows = np.arange(max(rstart, colsum[j]), min(rend, colsum[j+1])) - colsum[j]
+
+        i, idx, dist = _neighbour_pairs(np.asarray(coords[j]), lrows, max_dist[j])
+
+        rows.append(i + colsum[j])
+        cols.append(idx + colsum[j])
+        vals.append(func(np.asarray(sigma[j])[idx], dist, *args, **kwargs))
+
+    return assemble_matrix(rows, cols, vals, ((rend - rstart, nn), (rend - rstart, nn)))
 
 
 def create_covariance_matrix_index(sigma, coords, max_dist, index, func, *args, **kwargs):
@@ -158,43 +124,138 @@ def create_covariance_matrix_index(sigma, coords, max_dist, index, func, *args,
      func should always receive sigma and distance as first
      two inputs
     """
+    size = len(sigma)
+    sigma = np.asarray(sigma)
+    index = np.asarray(index)
+    max_dist = np.ones(size)*max_dist
+
+    # rows owned by this processor
+    rstart, rend = _owned_range(size)
+
+    rows, cols, vals = [], [], []
+    for l in np.unique(index):
+        indices = np.nonzero(index == l)[0]
+
+        # owned rows with this index
+        lrows = np.nonzero(np.logical_and(indices >= rstart, indices < rend))[0]
+
+        i, idx, dist = _neighbour_pairs(coords[indices], lrows, max_dist[indices])
+
+        rows.append(indices[i])
+        cols.append(indices[idx])
+        vals.append(func(sigma[indices][idx], dist, *args, **kwargs))
+
+    return assemble_matrix(rows, cols, vals, ((rend - rstart, size), (rend - rstart, size)))
+
+
+def _owned_range(size):
+    """
+    Range of rows owned by this processor in the default PETSc layout
+    """
+    nlocal = size//comm.size + int(comm.rank < size % comm.size)
+    rstart = comm.exscan(nlocal) or 0
+    return rstart, rstart + nlocal
+
+
+def _neighbour_pairs(coords, rows, max_dist):
+    """
+    Find every point within max_dist of each point in rows
+
+    Parameters
+    ----------
+     coords   : coordinates of all points
+     rows     : indices of the points to query
+     max_dist : search radius of each point
+
+    Returns
+    -------
+     row  : index of the queried point for each pair
+     col  : index of its neighbour
+     dist : distance between them
+    """
     from scipy.spatial import cKDTree
+
+    if rows.size == 0:
+        empty = np.array([], dtype=int)
+        return empty, empty, np.array([])
+
+    radius = max_dist[rows]
+
+    tree = cKDTree(coords)
+    rtree = cKDTree(coords[rows])
+    pairs = rtree.sparse_distance_matrix(tree, radius.max(), output_type='ndarray')
+
+    i, col, dist = pairs['i'], pairs['j'], pairs['v']
+    mask = dist <= radius[i]
+    return rows[i[mask]], col[mask], dist[mask]
+
+
+def assemble_matrix(rows, cols, vals, sizes, mat_type='aij'):
+    """
+    Assemble a distributed matrix from the COO arrays of the rows owned
+    by this processor.
+
+    Each row is preallocated with the exact number of nonzeros in the
+    diagonal and off-diagonal blocks, so no mallocs are needed during
+    insertion. Run with the PETSc option -debug_preallocation to report
+    the number of mallocs.
+
+    Parameters
+    ----------
+     rows     : global row indices (list of arrays or array)
+     cols     : global column indices
+     vals     : values
+     sizes    : ((local rows, global rows), (local cols, global cols))
+     mat_type : PETSc matrix type
+
+    Returns
+    -------
+     mat      : assembled PETSc Mat
+    """
     from petsc4py import PETSc
 
-    size = len(sigma)
+    rows = np.hstack(rows).astype(PETSc.IntType)
+    cols = np.hstack(cols).astype(PETSc.IntType)
+    vals = np.hstack(vals).astype(np.float64)
 
-    # find distance between coords and centroid
-    dist = np.linalg.norm(coords - coords.mean(axis=0), axis=1)
-    nnz = int(1.5*(dist <= max_dist).sum())
+    (nlocal, nrows), (ncol_local, ncols) = sizes
+    rstart = comm.exscan(nlocal) or 0
+    cstart = comm.exscan(ncol_local) or 0
+    cend = cstart + ncol_local
 
+    # sort by row then column to get CSR arrays
+    order = np.lexsort((cols, rows))
+    rows, cols, vals = rows[order], cols[order], vals[order]
+    lrows = rows - rstart
+
+    # exact nonzeros in the diagonal and off-diagonal blocks
+    diag = np.logical_and(cols >= cstart, cols < cend)
+    nnz = np.bincount(lrows, minlength=nlocal).astype(PETSc.IntType)
+    d_nnz = np.bincount(lrows, weights=diag, minlength=nlocal).astype(PETSc.IntType)
+    o_nnz = nnz - d_nnz
+    indptr = np.insert(np.cumsum(nnz), 0, 0).astype(PETSc.IntType)
 
-    # set up matrix
     mat = PETSc.Mat().create(comm)
-    mat.setType('aij')
-    mat.setSizes((size, size))
-    mat.setPreallocationNNZ((nnz,1))
-    mat.setOption(PETSc.Mat.Option.NEW_NONZERO_ALLOCATION_ERR, 0)
+    mat.setType(mat_type)
+    mat.setSizes(sizes)
     mat.setFromOptions()
-    mat.assemblyBegin()
-    
-    
-    lith_index = np.unique(index)
-
-    for l in lith_index:
-        indices = np.nonzero(index == l)[0].astype(PETSc.IntType)
-
-        icoord = coords[indices]
-        isigma = sigma[indices]
-        tree = cKDTree(icoord)
-
-        for i in indices:
-            idx = tree.query_ball_point(coords[i], max_dist)
-            dist = np.linalg.norm(coords[i] - icoord[idx], axis=1)
-            
-            row = i
-            col = indices[idx]
-            val = func(isigma[idx], dist, *args, **kwargs)
-            mat.setValues(row, col, val)
-
-    mat.assemblyEnd()
-    return mat
\ No newline at end of file
+    mat.setPreallocationNNZ((d_nnz, o_nnz))
+    mat.setValuesCSR(indptr, cols, vals)
+    mat.assemble()
+
+    _report_mallocs(mat)
+    return mat
+
+
+def _report_mallocs(mat):
+    """
+    Print the number of mallocs during assembly (there should be none)
+    if the PETSc option -debug_preallocation is set
+    """
+    from petsc4py import PETSc
+
+    if PETSc.Options().getBool('debug_preallocation', False):
+        info = mat.getInfo()
+        if comm.rank == 0:
+            print("matrix {}: {} nonzeros, {} mallocs during assembly".format(\
+                mat.getSize(), int(info['nz_used']), int(info['mallocs'])))
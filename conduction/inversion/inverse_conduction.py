@@ -264,6 +264,7 @@ class Inversion(object):
 
     def linear_solve_ad(self, T, dT, matrix=None, rhs=None):
 
+        release = matrix is None
         if matrix == None:
             matrix = self.mesh.construct_matrix(in_place=False)
         if rhs == None:
@@ -303,10 +304,15 @@ class Inversion(object):
                 self.mesh.diffusivity[:] = idx
                 dAdkl = self.mesh.construct_matrix(in_place=False, derivative=True)
                 dAdklT = dAdkl * res._gdata
+                self.mesh.release_matrix(dAdkl)
                 self.ksp.solve(dAdklT, gvec)
                 self.mesh.dm.globalToLocal(gvec, lvec)
                 dk_ad[idx] += dT_ad.dot(lvec.array)/idx_n.sum()
 
+        matrix_T.destroy()
+        if release:
+            self.mesh.release_matrix(matrix)
+
         return dk_ad, db_ad.array
 
     def gradient(self, T):
@@ -491,6 +497,7 @@ class Inversion(object):
             A.scale(-1.0)
 
             x1 = dA*self.temperature
+            self.mesh.release_matrix(dA)
             self.ksp.solve(x1, self.mesh.gvec)
 
             self._temperature += self.mesh.gvec
@@ -821,6 +828,7 @@ class Inversion(object):
                     # diag.array[idx_upperBC] = 0.0
                     # dAdkl.setDiagonal(diag)
                     dAdkl.mult(self._temperature, dAdklT)
+                    self.mesh.release_matrix(dAdkl)
                     self.ksp.setOperators(A)
                     self.ksp.solve(dAdklT, self.mesh.gvec)
                     self.mesh.dm.globalToLocal(self.mesh.gvec, self.mesh.lvec)
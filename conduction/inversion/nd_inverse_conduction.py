@@ -24,6 +24,7 @@ from ..interpolation import RegularGridInterpolator, KDTreeInterpolator
 from ..mesh import MeshVariable
 from ..tools import sum_duplicates
 from .objective_variables import InvPrior, InvObservation
+from .covariance import assemble_matrix, _neighbour_pairs
 from .grad_ad import gradient_ad as ad_grad
 
 from mpi4py import MPI
@@ -54,6 +55,7 @@ class InversionND(object):
         mesh.dm.localToGlobal(mesh.lvec, mesh.gvec, addv=True)
         mesh.dm.globalToLocal(mesh.gvec, mesh.lvec)
         self.ghost_weights = np.rint(mesh.lvec.array)
+        self._inv_ghost_weights = 1.0/self.ghost_weights
 
 
         # We assume uniform grid spacing for now
@@ -70,8 +72,16 @@ class InversionND(object):
 
 
         # Initialise linear solver
+        # (warm_start uses the previous temperature as the initial guess)
+        self.warm_start = kwargs.pop('warm_start', False)
         self.ksp = self._initialise_ksp(**kwargs)
 
+        # factored solvers for each covariance matrix
+        self._cov_solvers = {}
+
+        # bundles to sync several fields in one scatter (see map)
+        self._bundles = {}
+
         # these should be depreciated soon
         self.temperature = self.mesh.gvec.duplicate()
         self._temperature = self.mesh.gvec.duplicate()
@@ -96,13 +106,18 @@ class InversionND(object):
         -----
          lithology_index is determined from the min/max of elements
          in new_lithology if lithology_index=None
+
+         Nodes are grouped by lithology in CSR form: the nodes of
+         lithology i are _lithology_nodes[offsets[i]:offsets[i+1]].
+         If lithology_index is unchanged only the nodes that change
+         lithology are moved between groups.
         """
 
         new_lithology = np.array(new_lithology).ravel()
 
         # sync across processors
         new_lithology = self.mesh.sync(new_lithology)
-        new_lithology = new_lithology.astype(np.int)
+        new_lithology = new_lithology.astype(int)
 
         if type(lithology_index) == type(None):
             # query global vector for minx/max
@@ -112,20 +127,85 @@ class InversionND(object):
             # create lithology index
             lithology_index = np.arange(int(lith_min), int(lith_max)+1)
 
+        lithology_index = np.asarray(lithology_index)
+        old_lithology = getattr(self, '_lithology', None)
 
-        nl = len(lithology_index)
-        lithology_mask = [i for i in range(nl)]
-
-        # create lithology mask
-        for i, index in enumerate(lithology_index):
-            lithology_mask[i] = np.nonzero(new_lithology == index)[0]
+        if old_lithology is not None and old_lithology.size == new_lithology.size \
+           and np.array_equal(lithology_index, self.lithology_index):
+            changed = np.nonzero(new_lithology != old_lithology)[0]
+            new_slot = self._find_lithology_slots(new_lithology[changed], lithology_index)
+            self._regroup_lithology(changed, new_slot)
+        else:
+            self._lithology_slot = self._find_lithology_slots(new_lithology, lithology_index)
+            self._group_lithology(len(lithology_index))
 
-        self.lithology_mask = lithology_mask
         self.lithology_index = lithology_index
         self._lithology = new_lithology
 
         return
 
+    def _find_lithology_slots(self, lithology, lithology_index):
+        """
+        Position of each label in lithology_index
+        (len(lithology_index) for labels that are not in lithology_index)
+        """
+        nl = len(lithology_index)
+        sorter = np.argsort(lithology_index)
+        sorted_index = lithology_index[sorter]
+        pos = np.clip(np.searchsorted(sorted_index, lithology), 0, max(nl-1, 0))
+        slot = np.full(lithology.size, nl, dtype=PETSc.IntType)
+        if nl:
+            found = sorted_index[pos] == lithology
+            slot[found] = sorter[pos[found]]
+        return slot
+
+    def _group_lithology(self, nl):
+        """
+        Group nodes by lithology with one stable sort
+        """
+        slot = self._lithology_slot
+        counts = np.bincount(slot, minlength=nl+1)
+        self._lithology_nodes = np.argsort(slot, kind='stable').astype(PETSc.IntType)
+        self._lithology_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(PETSc.IntType)
+
+    def _regroup_lithology(self, changed, new_slot):
+        """
+        Move the changed nodes to their new lithology groups
+        """
+        slot = self._lithology_slot
+        nodes = self._lithology_nodes
+        nn = slot.size
+        nbins = self._lithology_offsets.size - 1
+
+        counts = np.diff(self._lithology_offsets)
+        counts -= np.bincount(slot[changed], minlength=nbins)
+        counts += np.bincount(new_slot, minlength=nbins)
+
+        is_changed = np.zeros(nn, dtype=bool)
+        is_changed[changed] = True
+        kept = nodes[~is_changed[nodes]]
+        slot[changed] = new_slot
+
+        # merge the changed nodes into the (lithology, node) ordering
+        order = np.argsort(new_slot, kind='stable')
+        moved = changed[order]
+        kept_keys = slot[kept].astype(np.int64)*nn + kept
+        moved_keys = slot[moved].astype(np.int64)*nn + moved
+        pos = np.searchsorted(kept_keys, moved_keys)
+
+        self._lithology_nodes = np.insert(kept, pos, moved).astype(PETSc.IntType)
+        self._lithology_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(PETSc.IntType)
+
+    @property
+    def lithology_mask(self):
+        """
+        Node indices of each lithology
+        (views into one contiguous array)
+        """
+        nodes = self._lithology_nodes
+        offsets = self._lithology_offsets
+        return [nodes[offsets[i]:offsets[i+1]] for i in range(len(self.lithology_index))]
+
     @property
     def lithology(self):
         return self._lithology
@@ -138,19 +218,30 @@ class InversionND(object):
         """
         Initialise linear solver object
         """
-        if matrix is None:
+        mesh_operator = matrix is None
+        if mesh_operator:
             matrix = self.mesh.mat
+            default_solver, default_pc = self.mesh._get_default_solver()
+        else:
+            default_solver, default_pc = 'gmres', None
 
-        solver = kwargs.pop('solver', 'gmres')
-        precon = kwargs.pop('pc', None)
+        solver = kwargs.pop('solver', default_solver)
+        precon = kwargs.pop('pc', default_pc)
+        mg_levels = kwargs.pop('mg_levels', None)
+        mg_galerkin = kwargs.pop('mg_galerkin', True)
 
         ksp = PETSc.KSP().create(comm)
         ksp.setType(solver)
         ksp.setOperators(matrix)
         ksp.setTolerances(atol, rtol)
+        if mesh_operator:
+            # grid hierarchy for multigrid
+            self.mesh._set_ksp_dm(ksp, self.mesh.dm)
         if precon is not None:
             pc = ksp.getPC()
             pc.setType(precon)
+            if precon == 'mg':
+                self.mesh._initialise_multigrid(pc, mg_levels, mg_galerkin)
         ksp.setFromOptions()
         return ksp
 
@@ -221,26 +312,166 @@ class InversionND(object):
         These will automatically be called when the objective function is called
         and will handle interpolation.
 
+        A sparse interpolation matrix from the mesh to the observations
+        is built once for each observation, so interpolation is a
+        matrix-vector product and its adjoint is the transpose product.
         """
-        interp = self.interp
-        interp.values = self.ghost_weights.reshape(self.mesh.n)
-
         for arg in kwargs:
             obs = kwargs[arg]
             if type(obs) is not InvObservation:
                 raise TypeError("Need to pass {} instead of {}".format(InvObservation,type(obs)))
 
             # add interpolation information to obs
-            w = interp(obs.coords[:,::-1])
-            w = 1.0/np.floor(w + 1e-12)
-            offproc = np.isnan(w)
-            w[offproc] = 0.0 # these are weighted with zeros
-            obs.w = w # careful with 2x ghost nodes+
+            mat, rows, inbounds = self.create_interpolation_matrix(obs.coords, obs.method)
+            obs.interp_mat = mat
+            obs.rows = rows
+            obs.inbounds = inbounds
+            obs._ivec = mat.createVecLeft()
+            obs.w = 1.0 # each observation belongs to one processor
 
             # store in dictionary
             self.observation[arg] = obs
 
 
+    def create_interpolation_matrix(self, coords, method="nearest"):
+        """
+        Create a sparse matrix that interpolates a global vector on the
+        mesh to a set of coordinates.
+
+        Each coordinate is interpolated by the one processor that owns
+        the nearest node (or the lower corner of the enclosing cell).
+        If every processor passes the same coordinates the rows are
+        distributed in the default PETSc layout, otherwise each processor
+        keeps the rows of its own coordinates (e.g. mesh.coords).
+
+        Arguments
+        ---------
+         coords : ndarray shape (n, dim) coordinates to interpolate to
+         method : 'nearest' or 'linear' (multilinear on the mesh)
+
+        Returns
+        -------
+         mat      : PETSc Mat of shape (n, mesh nodes)
+         rows     : slice of coords in the rows owned by this processor
+         inbounds : bool array, owned rows that interpolate from the mesh
+        """
+        import zlib
+
+        mesh = self.mesh
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, mesh.dim)
+        nobs = coords.shape[0]
+
+        # nodes owned by this processor
+        gstart, gend = mesh.gvec.getOwnershipRange()
+        gnodes = mesh.lgmap.apply(mesh.nodes)
+        owned = np.logical_and(gnodes >= gstart, gnodes < gend)
+
+        if method == "nearest":
+            idx, d, bounds = self.ndinterp._find_indices(coords)
+            claim = np.logical_and(~bounds, owned[idx])
+            rows = np.nonzero(claim)[0]
+            cols = idx[claim]
+            vals = np.ones(rows.size)
+        elif method == "linear":
+            ncorners = 2**mesh.dim
+            lower = np.zeros(nobs, dtype=PETSc.IntType)
+            corners = np.zeros((nobs, ncorners), dtype=PETSc.IntType)
+            weights = np.ones((nobs, ncorners))
+            inside = np.ones(nobs, dtype=bool)
+
+            stride = 1
+            for i in range(0, mesh.dim):
+                x = coords[:,i]
+                grid = mesh.grid_coords[i]
+                inside &= np.logical_and(x >= grid[0], x <= grid[-1])
+
+                j = np.clip(np.searchsorted(grid, x, side='right') - 1, 0, grid.size - 2)
+                t = (x - grid[j])/(grid[j+1] - grid[j])
+                lower += j*stride
+
+                # corner c takes the upper node along dimension i if bit i is set
+                for c in range(0, ncorners):
+                    upper = (c >> i) & 1
+                    corners[:,c] += (j + upper)*stride
+                    weights[:,c] *= t if upper else 1.0 - t
+
+                stride *= grid.size
+
+            claim = np.logical_and(inside, owned[lower])
+            rows = np.repeat(np.nonzero(claim)[0], ncorners)
+            cols = corners[claim].ravel()
+            vals = weights[claim].ravel()
+        else:
+            raise ValueError("Method '{}' is not defined".format(method))
+
+        checksum = (nobs, zlib.crc32(np.ascontiguousarray(coords).tobytes()))
+        replicated = all([c == checksum for c in comm.allgather(checksum)])
+
+        if replicated:
+            # observations on processor boundaries go to the lowest rank
+            claim_rank = np.full(nobs, comm.size, dtype=np.int32)
+            claim_rank[rows] = comm.rank
+            owner = np.empty_like(claim_rank)
+            comm.Allreduce([claim_rank, MPI.INT], [owner, MPI.INT], op=MPI.MIN)
+
+            keep = owner[rows] == comm.rank
+            rows, cols, vals = rows[keep], cols[keep], vals[keep]
+            sizes = (PETSc.DECIDE, nobs)
+            offset = 0
+            inside = owner < comm.size
+        else:
+            inside = np.zeros(nobs, dtype=bool)
+            inside[rows] = True
+            sizes = (nobs, PETSc.DETERMINE)
+            offset = comm.exscan(nobs) or 0
+
+        rows = (rows + offset).astype(PETSc.IntType)
+        cols = mesh.lgmap.apply(cols.astype(PETSc.IntType))
+
+        mat = PETSc.Mat().create(comm=comm)
+        mat.setType('aij')
+        mat.setSizes((sizes, mesh.sizes[0]))
+        mat.setPreallocationCOO(rows, cols)
+        mat.setValuesCOO(vals)
+        mat.assemble()
+
+        rstart, rend = mat.getOwnershipRange()
+        rows = slice(rstart - offset, rend - offset)
+        inbounds = inside[rows]
+        return mat, rows, inbounds
+
+
+    def interpolate_observation(self, obs, field):
+        """
+        Interpolate a local field to the observation rows owned by
+        this processor with the precomputed interpolation matrix
+        """
+        mesh = self.mesh
+        mesh.lvec.setArray(field)
+        mesh.dm.localToGlobal(mesh.lvec, mesh.gvec)
+        obs.interp_mat.mult(mesh.gvec, obs._ivec)
+        return obs._ivec.array.copy()
+
+    def interpolate_observation_ad(self, obs, dival):
+        """
+        Adjoint of interpolate_observation
+        returns a local field that is synchronised across processors
+        """
+        mesh = self.mesh
+        obs._ivec.setArray(dival)
+        obs.interp_mat.multTranspose(obs._ivec, mesh.gvec)
+        mesh.dm.globalToLocal(mesh.gvec, mesh.lvec)
+        return mesh.lvec.array.copy()
+
+    def _observation_rows(self, obs, x):
+        """
+        Entries of an observation array owned by this processor
+        """
+        if np.ndim(x) == 0:
+            return x
+        return np.asarray(x)[obs.rows]
+
+
     def add_prior(self, **kwargs):
         """
         Add a prior to the Inversion routine
@@ -285,14 +516,22 @@ class InversionND(object):
             elif arg in self.observation:
                 obs = self.observation[arg]
 
-                # interpolation
-                ival = self.interpolate(val, obs.coords)
+                # interpolation to the observations on this processor
+                ival = self.interpolate_observation(obs, val)
+                v = self._observation_rows(obs, obs.v)
+                dv = self._observation_rows(obs, obs.dv)
+
+                # observations outside the mesh do not contribute
+                ival[~obs.inbounds] = v[~obs.inbounds]
 
-                # weighting for ghost nodes
                 if obs.cov is None:
-                    c_obs += self.objective_function(ival*obs.w, obs.v*obs.w, obs.dv)
+                    c_obs += self.objective_function(ival, v, dv)
                 else:
-                    c_obs += self.objective_function_lstsq(ival*obs.w, obs.v*obs.w, obs.cov)
+                    x = np.zeros(len(obs.v))
+                    x0 = np.zeros(len(obs.v))
+                    x[obs.rows] = ival
+                    x0[obs.rows] = v
+                    c_obs += self.objective_function_lstsq(x, x0, obs.cov)
 
 
 
@@ -316,20 +555,22 @@ class InversionND(object):
             elif arg in self.observation:
                 obs = self.observation[arg]
 
-                ival = self.interpolate(val, obs.coords)
-
+                ival = self.interpolate_observation(obs, val)
+                v = self._observation_rows(obs, obs.v)
+                dv = self._observation_rows(obs, obs.dv)
+                ival[~obs.inbounds] = v[~obs.inbounds]
 
                 if obs.cov is None:
-                    dcdinterp = self.objective_function_ad(ival, obs.v, obs.dv)
+                    dcdinterp = self.objective_function_ad(ival, v, dv)
                 else:
-                    dcdinterp = self.objective_function_lstsq_ad(ival*obs.w, obs.v*obs.w, obs.cov)
-
-                # interpolation
-                dcdv = self.interpolate_ad(dcdinterp, val, obs.coords)
-                # print arg, np.shape(val), np.shape(ival), np.shape(dcdv)
-
-                # sync
-                dcdv = self.mesh.sync(dcdv)
+                    x = np.zeros(len(obs.v))
+                    x0 = np.zeros(len(obs.v))
+                    x[obs.rows] = ival
+                    x0[obs.rows] = v
+                    dcdinterp = self.objective_function_lstsq_ad(x, x0, obs.cov)[obs.rows]
+
+                # interpolation adjoint (synchronised across processors)
+                dcdv = self.interpolate_observation_ad(obs, dcdinterp)
             else:
                 dcdv = np.zeros_like(val)
 
@@ -346,6 +587,8 @@ class InversionND(object):
          sigma_x0 : uncertainty values to insert into matrix
          width    : width of stencil for matrix (int)
             i.e. extended number of neighbours for each node
+            (cannot exceed the stencil width of the mesh in parallel,
+            see create_covariance_matrix_kdtree)
          indexing : use the xy coordinates of the mesh nodes or indices
             set to 'xy' or 'ij'
          fn       : function to apply (default is Gaussian)
@@ -362,6 +605,11 @@ class InversionND(object):
         if type(fn) == type(None):
             fn = gaussian_fn
 
+        # rows near processor boundaries would lose entries beyond the ghost nodes
+        if width > self.mesh.width and comm.size > 1:
+            raise ValueError("width cannot exceed the stencil width of the mesh ({}) in parallel,\
+ use create_covariance_matrix_kdtree instead".format(self.mesh.width))
+
         nodes = self.mesh.nodes
         nn = self.mesh.nn
         n = self.mesh.n
@@ -373,7 +621,7 @@ class InversionND(object):
             ic = []
             for i in range(dim):
                 ic.append( np.arange(n[i]) )
-            cij = np.meshgrid(*ic, indexing="ij")
+            cij = list(np.meshgrid(*ic, indexing="ij"))
 
             for i in range(dim):
                 cij[i] = cij[i].ravel()
@@ -417,14 +665,7 @@ class InversionND(object):
         mask = col >= 0
         row, col, val = sum_duplicates(row[mask], col[mask], val[mask])
 
-        nnz = np.bincount(row)
-        indptr = np.insert(np.cumsum(nnz),0,0)
-
-        nnz = (stencil_width, dim*2)
-        mat = self.mesh._initialise_matrix(nnz=nnz)
-        mat.assemblyBegin()
-        mat.setValuesLocalCSR(indptr.astype(PETSc.IntType), col, val)
-        mat.assemblyEnd()
+        mat = self._assemble_covariance(row, col, val)
 
         # set diagonal vector
         lvec = self.mesh.lvec
@@ -441,14 +682,17 @@ class InversionND(object):
         By default this is Gaussian.
 
         This uses a KDTree to determine distance between nodes, rather than the
-        matrix stencil indexing used by create_covariance_matrix
-        
+        matrix stencil indexing used by create_covariance_matrix.
+        Each processor receives a halo of nodes from its neighbours that is
+        wide enough to hold every node within range of its own, so width
+        is not limited by the stencil width of the mesh.
 
         Arguments
         ---------
          sigma_x0 : uncertainty values to insert into matrix
          width    : width of stencil for matrix (int)
             i.e. extended number of neighbours for each node
+            (the halo cannot extend past the neighbouring processors)
          indexing : use the xy coordinates of the mesh nodes or indices
             set to 'xy' or 'ij'
          fn       : function to apply (default is Gaussian)
@@ -465,46 +709,143 @@ class InversionND(object):
         if type(fn) == type(None):
             fn = gaussian_fn
 
-        nodes = self.mesh.nodes
-        nn = self.mesh.nn
         n = self.mesh.n
         dim = self.mesh.dim
 
         if indexing == "xy":
             coords = self.mesh.coords
-            tree = self.ndinterp.tree
+            extent = self.mesh.extent.reshape(dim, -1)
+            spacing = (extent[:,1] - extent[:,0])/(np.array(self.mesh.dm.getSizes()) - 1)
+            max_dist = width*spacing.max()
+
+            # the smallest spacing sets how many nodes fit within max_dist
+            # (nodes may be unevenly spaced after refine)
+            min_spacing = np.inf
+            grid = coords.reshape(tuple(n) + (dim,))
+            for i in range(dim):
+                axis = dim - 1 - i
+                dx = np.diff(grid[...,i], axis=axis)
+                if dx.size:
+                    min_spacing = min(min_spacing, np.abs(dx).min())
+            min_spacing = comm.allreduce(min_spacing, op=MPI.MIN)
+            halo = int(np.ceil(max_dist*(1.0 + 1e-8)/min_spacing))
         elif indexing == "ij":
-            from scipy.spatial import cKDTree
-
+            # global grid indices of the local nodes
             ic = []
-            for i in range(dim):
-                ic.append( np.arange(n[i]) )
-            cij = np.meshgrid(*ic, indexing="ij")
+            for gs, ge in self.mesh.dm.getGhostRanges()[::-1]:
+                ic.append( np.arange(gs, ge) )
+            cij = list(np.meshgrid(*ic, indexing="ij"))
 
             for i in range(dim):
                 cij[i] = cij[i].ravel()
             coords = np.column_stack(cij)
-            tree = cKDTree(coords)
+            max_dist = float(width)
+            halo = int(width)
+
+        # exchange sigma and coordinates with a halo of neighbouring nodes
+        halo_dm, fields = self._halo_nodes(halo, sigma_x0, *coords.T)
+        sigma = fields[0]
+        coords = np.column_stack(fields[1:])
+
+        # query neighbours of owned rows only
+        rows = np.nonzero(self._halo_owned_nodes(halo_dm))[0]
+        radius = np.full(sigma.size, max_dist*(1.0 + 1e-8))
+        row, col, dist = _neighbour_pairs(coords, rows, radius)
+        val = fn(sigma[col], dist, *args)
+
+        # halo_dm numbers nodes in the same global order as the mesh
+        lgmap = halo_dm.getLGMap()
+        row = lgmap.applyBlock(row.astype(PETSc.IntType))
+        col = lgmap.applyBlock(col.astype(PETSc.IntType))
+        halo_dm.destroy()
+
+        mat = assemble_matrix(row, col, val, self.mesh.sizes, self.mesh.MatType)
+        mat.setLGMap(self.mesh.lgmap)
+        return mat
 
 
-        # find distance between coords and centroid
-        dist = np.linalg.norm(coords - coords.mean(axis=0), axis=1)
-        nnz = int(1.5*(dist <= max_dist).sum())
+    def _halo_nodes(self, halo, *fields):
+        """
+        Exchange local fields with a halo of the given width on a DMDA
+        with the same layout as the mesh and a box stencil
 
-        mat = self.mesh._initialise_matrix(nnz=(nnz,1))
-        mat.assemblyBegin()
+        Returns
+        -------
+         halo_dm : DMDA with one degree of freedom per field
+         fields  : each field on the local nodes of halo_dm
+        """
+        mesh = self.mesh
+        dm = mesh.dm
+
+        # the halo can only be taken from the neighbouring processors
+        proc_sizes = dm.getProcSizes()
+        local_size = [e - s for s, e in dm.getRanges()]
+        min_size = min([local_size[i] for i in range(mesh.dim) if proc_sizes[i] > 1] or [np.inf])
+        min_size = comm.allreduce(min_size, op=MPI.MIN)
+        if halo > min_size:
+            raise ValueError("width spans {} nodes but the smallest processor domain has {},\
+ use fewer processors or a smaller width".format(halo, min_size))
+
+        nfields = len(fields)
+        halo_dm = PETSc.DMDA().create(dim=mesh.dim, dof=nfields, sizes=dm.getSizes(),
+                                      proc_sizes=proc_sizes,
+                                      ownership_ranges=dm.getOwnershipRanges(),
+                                      stencil_type=PETSc.DMDA.StencilType.BOX,
+                                      stencil_width=halo, comm=dm.comm)
+
+        gvec = halo_dm.createGlobalVector()
+        lvec = halo_dm.createLocalVector()
+
+        garray = gvec.array.reshape(-1, nfields)
+        for i, field in enumerate(fields):
+            mesh.lvec.setArray(field)
+            dm.localToGlobal(mesh.lvec, mesh.gvec)
+            garray[:,i] = mesh.gvec.array
+
+        halo_dm.globalToLocal(gvec, lvec)
+        larray = lvec.array.reshape(-1, nfields)
+        fields = [larray[:,i].copy() for i in range(nfields)]
+
+        gvec.destroy()
+        lvec.destroy()
+        return halo_dm, fields
+
+
+    @staticmethod
+    def _halo_owned_nodes(halo_dm):
+        """
+        Mask of the local nodes of halo_dm owned by this processor
+        """
+        owned = []
+        for (s, e), (gs, ge) in zip(halo_dm.getRanges(), halo_dm.getGhostRanges()):
+            idx = np.arange(gs, ge)
+            owned.append(np.logical_and(idx >= s, idx < e))
+        owned = np.meshgrid(*owned[::-1], indexing="ij")
+        return np.logical_and.reduce([o.ravel() for o in owned])
 
-        for i in range(0, nn):
-            idx = tree.query_ball_point(coords[i], max_dist)
-            dist = np.linalg.norm(coords[i] - coords[idx], axis=1)
-            
-            row = i
-            col = idx
-            val = fn(sigma[idx], dist, *args, **kwargs)
-            
-            mat.setValues(row, col, val)
 
-        mat.assemblyEnd()
+    def _owned_nodes(self):
+        """
+        Mask of local nodes owned by this processor
+        """
+        rstart, rend = self.mesh.gvec.getOwnershipRange()
+        gnodes = self.mesh.lgmap.apply(self.mesh.nodes.astype(PETSc.IntType))
+        return np.logical_and(gnodes >= rstart, gnodes < rend)
+
+
+    def _assemble_covariance(self, row, col, val):
+        """
+        Assemble a covariance matrix from entries in local indices.
+        Rows owned by other processors are dropped and every row is
+        preallocated exactly (see covariance.assemble_matrix).
+        """
+        mask = self._owned_nodes()[row]
+        lgmap = self.mesh.lgmap
+        row = lgmap.apply(row[mask].astype(PETSc.IntType))
+        col = lgmap.apply(col[mask].astype(PETSc.IntType))
+
+        mat = assemble_matrix(row, col, val[mask], self.mesh.sizes, self.mesh.MatType)
+        mat.setLGMap(lgmap)
         return mat
 
 
@@ -531,47 +872,67 @@ class InversionND(object):
         return 0.5*(2.0*x - 2.0*x0)/sigma_x0**2
 
 
-    def objective_function_lstsq(self, x, x0, cov):
+    def _get_covariance_solver(self, cov):
         """
-        Nonlinear least squares objective function
+        Retrieve the LU-factored KSP and work vectors for a covariance matrix.
+
+        These are cached for each Mat object so repeated evaluations of the
+        objective function reuse the factorisation. PETSc compares the state
+        of the Mat on every solve and refactors it only if the entries change.
+        """
+        key = id(cov)
+        if key not in self._cov_solvers:
+            ksp = self._initialise_ksp(cov, pc='lu')
+            lhs, rhs = cov.createVecs()
+            toall, allvec = PETSc.Scatter.toAll(lhs)
+            # keep a reference to cov so its id is not recycled
+            self._cov_solvers[key] = (cov, ksp, lhs, rhs, toall, allvec)
+        return self._cov_solvers[key][1:]
+
+    def _solve_covariance(self, x, x0, cov):
         """
-        ksp = self._initialise_ksp(cov, pc='lu')
+        Solve C^-1 (x - x0) with the cached covariance solver
+        """
+        ksp, lhs, rhs, toall, allvec = self._get_covariance_solver(cov)
+
         misfit = np.array(x - x0)
-        lhs, rhs = cov.createVecs()
         rhs.set(0.0)
         lindices = np.arange(0, misfit.size, dtype=PETSc.IntType)
         rhs.setValues(lindices, misfit, PETSc.InsertMode.ADD_VALUES)
         rhs.assemble()
         ksp.solve(rhs, lhs)
-        sol = rhs*lhs
-        sol.scale(0.5)
+        return lhs, rhs
 
-        ksp.destroy()
-        lhs.destroy()
-        rhs.destroy()
+    def release_covariance_solvers(self):
+        """
+        Destroy cached covariance solvers (e.g. when the matrices are discarded)
+        """
+        for cov, ksp, lhs, rhs, toall, allvec in self._cov_solvers.values():
+            ksp.destroy()
+            lhs.destroy()
+            rhs.destroy()
+            toall.destroy()
+            allvec.destroy()
+        self._cov_solvers.clear()
 
+    def objective_function_lstsq(self, x, x0, cov):
+        """
+        Nonlinear least squares objective function
+        """
+        lhs, rhs = self._solve_covariance(x, x0, cov)
+        sol = rhs*lhs
+        sol.scale(0.5)
         return sol.sum()/comm.size
 
     def objective_function_lstsq_ad(self, x, x0, cov):
         """
         Adjoint of the nonlinear least squares objective function
         """
-        ksp = self._initialise_ksp(cov, pc='lu')
-
-        misfit = np.array(x - x0)
-        lhs, rhs = cov.createVecs()
-        rhs.set(0.0)
-        lindices = np.arange(0, misfit.size, dtype=PETSc.IntType)
-        rhs.setValues(lindices, misfit, PETSc.InsertMode.ADD_VALUES)
-        rhs.assemble()
-        ksp.solve(rhs, lhs)
+        lhs, rhs = self._solve_covariance(x, x0, cov)
 
-        toall, allvec = PETSc.Scatter.toAll(lhs)
+        toall, allvec = self._get_covariance_solver(cov)[-2:]
         toall.scatter(lhs, allvec, PETSc.InsertMode.INSERT)
-
-        ksp.destroy()
-        lhs.destroy()
-        return allvec.array
+        return allvec.array.copy()
 
 
     def map(self, *args):
@@ -585,20 +946,20 @@ class InversionND(object):
         nf = len(args)
         nl = len(self.lithology_index)
 
-        # preallocate local memory
-        mesh_variables = np.zeros((nf, self.mesh.nn))
+        # table of values for each lithology (last row for unknown labels)
+        table = np.zeros((nl + 1, nf))
+        for f in range(nf):
+            table[:nl,f] = args[f]
 
-        # unpack vector to field
-        for i in range(0, nl):
-            idx = self.lithology_mask[i]
-            for f in range(nf):
-                mesh_variables[f,idx] = args[f][i]
+        # unpack vector to field in one gather
+        bundle = self._get_bundle(nf)
+        mesh_variables = bundle.array
+        mesh_variables[:] = table[self._lithology_slot]
 
         # sync fields across processors
-        for f in range(nf):
-            mesh_variables[f] = self.mesh.sync(mesh_variables[f])
+        fields = bundle.sync()
 
-        return list(mesh_variables)
+        return [field.copy() for field in fields]
 
     def map_ad(self, *args):
         """
@@ -609,22 +970,31 @@ class InversionND(object):
         nl = len(self.lithology_index)
 
         # sync fields across processors
-        mesh_variables = np.zeros((nf, self.mesh.nn))
-        for f in range(nf):
-            mesh_variables[f] = self.mesh.sync(args[f])
+        bundle = self._get_bundle(nf)
+        mesh_variables = bundle.sync(*args)
 
-        lith_variables = np.zeros((nf, self.lithology_index.size))
+        lith_variables = np.zeros((nf, nl))
         all_lith_variables = np.zeros_like(lith_variables)
 
-        for i in range(0, nl):
-            idx = self.lithology_mask[i]
-            for f in range(nf):
-                lith_variables[f,i] += (mesh_variables[f]/self.ghost_weights)[idx].sum()
+        # sum each lithology with ghost nodes weighted by their multiplicity
+        slot = self._lithology_slot
+        for f in range(nf):
+            weights = mesh_variables[f]*self._inv_ghost_weights
+            lith_variables[f] = np.bincount(slot, weights=weights, minlength=nl+1)[:nl]
 
         comm.Allreduce([lith_variables, MPI.DOUBLE], [all_lith_variables, MPI.DOUBLE], op=MPI.SUM)
 
         return list(all_lith_variables)
 
+    def _get_bundle(self, nf):
+        """
+        Mesh variable bundle with nf fields (cached)
+        """
+        if nf not in self._bundles:
+            names = ["field_{}".format(f) for f in range(nf)]
+            self._bundles[nf] = self.mesh.create_meshVariableBundle(*names)
+        return self._bundles[nf]
+
 
     def create_wall_map(self, wall, *args):
         coords = self.mesh.coords
@@ -690,7 +1060,10 @@ class InversionND(object):
 
 
     def linear_solve(self, matrix=None, rhs=None):
-
+        """
+        Solve for temperature.
+        If warm_start is enabled the previous temperature is the initial guess.
+        """
         if matrix == None:
             matrix = self.mesh.construct_matrix()
         if rhs == None:
@@ -703,19 +1076,30 @@ class InversionND(object):
         # res._gdata.setArray(rhs._gdata)
 
         self.ksp.setOperators(matrix)
-        self.ksp.solve(rhs._gdata, res._gdata)
+        self.ksp.setInitialGuessNonzero(self.warm_start)
+        self.mesh._solve(self.ksp, rhs, res._gdata)
         return res[:].copy()
 
     def linear_solve_ad(self, T, dT, matrix=None, rhs=None):
         """
-        If dT  = 0, adjoint=False : no need for this routine
-        If dT != 0 and inside lithology, lith_size > 0
+        Adjoint of the linear solve.
+
+        A single transpose solve gives the adjoint vector lambda = A^-T dT,
+        which is the sensitivity to the rhs. The sensitivity to diffusivity
+        -lambda^T (dA/dk) T is returned for every node
+        (see ConductionND.diffusivity_sensitivity) and can be summed
+        into lithologies with map_ad.
+
+        If dT = 0, adjoint=False : no need for this routine
+
+        Returns
+        -------
+         dk_ad : ndarray shape(n,) nodewise gradient w.r.t. diffusivity
+         db_ad : ndarray shape(n,) gradient w.r.t. the rhs vector
         """
         adjoint = np.array(False)
-        lith_size = np.array(0.0)
 
-        idxT = np.nonzero(dT != 0.0)[0]
-        nT = idxT.any()
+        nT = np.any(dT != 0.0)
         comm.Allreduce([nT, MPI.BOOL], [adjoint, MPI.BOOL], op=MPI.LOR)
         if adjoint:
             if matrix == None:
@@ -727,58 +1111,21 @@ class InversionND(object):
             gvec = self.mesh.gvec
             lvec = self.mesh.lvec
 
-            res = self.mesh.temperature
-            res[:] = T
-
             # adjoint b vec
             db_ad = lvec.duplicate()
 
             gvec.setArray(rhs._gdata)
-            self.ksp.solveTranspose(rhs._gdata, gvec)
+            self.ksp.setOperators(matrix)
+            self.mesh._solve(self.ksp, rhs, gvec, transpose=True)
             self.mesh.dm.globalToLocal(gvec, db_ad)
 
+            db = db_ad.array.copy()
+            db_ad.destroy()
+
             # adjoint A mat
-            dk_ad = np.zeros_like(T)
-
-            matrix.scale(-1.0)
-            # self.mesh.boundary_condition('maxZ', 0.0, flux=False) # not ND!!
-            dT_ad = dT[:]
-            kappa = np.zeros_like(T)
-            
-            nl = len(self.lithology_index)
-            for i in range(0, nl):
-                # find if there are nonzero dT that intersect a lithology
-                idxM  = self.lithology_mask[i]
-                idx_n = np.intersect1d(idxT, idxM)
-                gnodes = self.ghost_weights[idx_n]
-                local_size = np.array(float(idx_n.size)) - np.sum(1.0 - 1.0/gnodes) # ghost nodes
-                comm.Allreduce([local_size, MPI.DOUBLE], [lith_size, MPI.DOUBLE], op=MPI.SUM)
-                # print comm.rank, i, lith_size, idx_n.size
-
-                if lith_size > 0:
-                    kappa.fill(0.0)
-                    kappa[idxM] = 1.0
-                    self.mesh.diffusivity[:] = kappa
-                    dAdkl = self.mesh.construct_matrix(in_place=False, derivative=True)
-                    dAdklT = dAdkl * res._gdata
-                    gvec.setArray(dAdklT) # try make the solution somewhat close
-                    self.ksp.solve(dAdklT, gvec)
-                    self.mesh.dm.globalToLocal(gvec, lvec)
-
-                    # need to call sum on the global vec
-                    dk_local = (dT_ad*lvec.array)/lith_size
-                    lvec.setArray(dk_local)
-                    self.mesh.dm.localToGlobal(lvec, gvec)
-                    gdot = gvec.sum()
-
-                    if local_size > 0:
-                        # splatter inside vector
-                        dk_ad[idx_n] += gdot
-
-            dk_ad = self.mesh.sync(dk_ad)
-
-
-            return dk_ad, db_ad.array
+            dk_ad = self.mesh.diffusivity_sensitivity(T, db)
+
+            return dk_ad, db
         else:
             return np.zeros_like(T), np.zeros_like(T)
 
@@ -885,8 +1232,11 @@ class InversionND(object):
         # preallocate memory
         V = np.zeros((nf, self.mesh.nn))
 
+        nodes = self._lithology_nodes
+        offsets = self._lithology_offsets
+
         for i in range(0, nl):
-            idx = self.lithology_mask[i]
+            idx = nodes[offsets[i]:offsets[i+1]]
             lith_idx = self.lithology_index[i]
             V[:,idx] = self.TPtable(T[idx], P[idx], lith_idx).T
 
@@ -36,19 +36,25 @@ class InvObservation(object):
                 : (optional) ndarray shape (n, dim)
      cov_mat    : data covariance matrix
                   (optional) uses the l2-norm otherwise
+     method     : interpolation from the mesh to obs_coords
+                  'nearest' (default) or 'linear'
     """
-    def __init__(self, obs, obs_err, obs_coords=None, cov_mat=None):
+    def __init__(self, obs, obs_err, obs_coords=None, cov_mat=None, method='nearest'):
 
         self.v = obs
         self.dv = obs_err
         self.coords = obs_coords
         self.cov = cov_mat
+        self.method = method
 
         # self.gweight = self.ghost_weights()
 
     def __delete__(self):
         if type(self.cov) != type(None):
             self.cov.destroy()
+        if getattr(self, 'interp_mat', None) is not None:
+            self.interp_mat.destroy()
+            self._ivec.destroy()
 
     def construct_covariance_matrix(self, max_dist, func=gaussian_function, *args, **kwargs):
         """
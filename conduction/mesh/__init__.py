@@ -16,4 +16,4 @@ You should have received a copy of the GNU Lesser General Public License
 along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-from .mesh_variables import MeshVariable
\ No newline at end of file
+from .mesh_variables import MeshVariable, MeshVariableBundle
\ No newline at end of file
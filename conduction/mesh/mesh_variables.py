@@ -16,13 +16,22 @@ You should have received a copy of the GNU Lesser General Public License
 along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+from contextlib import contextmanager
+from mpi4py import MPI
+
 class MeshVariable(object):
     """
     Mesh variables live on the global mesh
     Every time its data is called a local instance is returned
+
+    The local vector is only refreshed from the global vector when
+    either has changed since the last scatter on any processor (tracked
+    with the PETSc object state). Use local_view or global_view to work
+    on the arrays in place with a single synchronisation on exit.
     """
     def __init__(self, name, dm):
         self._dm = dm
+        self._comm = dm.comm.tompi4py()
         name = str(name)
 
         # mesh variable vector
@@ -34,22 +43,74 @@ class MeshVariable(object):
 
         self.size = self._ldata.getSizes()[0]
 
+        # object states of (global, local) when they were last in sync
+        self._state = None
+
     def __delete__(self):
         self._ldata.destroy()
         self._gdata.destroy()
 
+    def _sync_local(self):
+        """
+        Scatter the global vector to the local vector if either
+        has changed since the last scatter on any processor.
+        The scatter is collective so every processor must agree.
+        """
+        _sync_local(self)
+
     def __getitem__(self, pos):
-        self._dm.globalToLocal(self._gdata, self._ldata)
+        self._sync_local()
         return self._ldata[pos]
 
     def __setitem__(self, pos, value):
+        # ghost values are refreshed from their owners on the next read
         self._ldata[pos] = value
         self._dm.localToGlobal(self._ldata, self._gdata)
 
 
+    @contextmanager
+    def local_view(self, readonly=False):
+        """
+        Context manager that returns a NumPy view of the local
+        (ghosted) array. Changes are sent to the global vector
+        with one scatter on exit.
+
+            with var.local_view() as a:
+                a *= 2.0
+
+        Arguments
+        ---------
+         readonly : bool, skip the scatter on exit
+        """
+        self._sync_local()
+        if readonly:
+            yield self._ldata.array_r
+        else:
+            yield self._ldata.array
+            self._ldata.stateIncrease()
+            self._dm.localToGlobal(self._ldata, self._gdata)
+
+    @contextmanager
+    def global_view(self, readonly=False):
+        """
+        Context manager that returns a NumPy view of the array
+        owned by this processor. The local vector is refreshed
+        with one scatter the next time it is read.
+
+        Arguments
+        ---------
+         readonly : bool, the array is not modified
+        """
+        if readonly:
+            yield self._gdata.array_r
+        else:
+            yield self._gdata.array
+            self._gdata.stateIncrease()
+
+
     @property
     def array(self):
-        self._dm.globalToLocal(self._gdata, self._ldata)
+        self._sync_local()
         return self._ldata
 
 
@@ -59,7 +120,7 @@ class MeshVariable(object):
 
     @data.getter
     def data(self):
-        self._dm.globalToLocal(self._gdata, self._ldata)
+        self._sync_local()
         return self._ldata
 
     @data.setter
@@ -67,6 +128,7 @@ class MeshVariable(object):
         if type(val) is float:
             self._ldata.set(val)
             self._gdata.set(val)
+            self._state = (self._gdata.stateGet(), self._ldata.stateGet())
         else:
             self._ldata.setArray(val)
             self._dm.localToGlobal(self._ldata, self._gdata)
@@ -80,4 +142,140 @@ class MeshVariable(object):
         return self._gdata
 
     def getLocal(self):
-        return self._ldata
\ No newline at end of file
+        return self._ldata
+
+class MeshVariableBundle(object):
+    """
+    Several mesh variables interlaced on one DMDA with a degree of
+    freedom per variable, so that all of them are exchanged between
+    processors in a single scatter.
+
+    Each variable is accessed by name (or position) as a NumPy view
+    of its column in the local array.
+
+    Parameters
+    ----------
+     names : list of variable names
+     dm    : PETSc DMDA of a single mesh variable
+    """
+    def __init__(self, names, dm):
+        self.names = [str(name) for name in names]
+        self.ncomponents = len(self.names)
+        self._index = dict([(name, i) for i, name in enumerate(self.names)])
+
+        self._dm = dm.duplicate(dof=self.ncomponents)
+        self._comm = self._dm.comm.tompi4py()
+
+        self._gdata = self._dm.createGlobalVector()
+        self._ldata = self._dm.createLocalVector()
+        for i, name in enumerate(self.names):
+            self._dm.setFieldName(i, name)
+
+        self.size = self._ldata.getSizes()[0] // self.ncomponents
+
+        # object states of (global, local) when they were last in sync
+        self._state = None
+
+    def __delete__(self):
+        self._ldata.destroy()
+        self._gdata.destroy()
+        self._dm.destroy()
+
+    def _sync_local(self):
+        _sync_local(self)
+
+    def _component(self, key):
+        if key in self._index:
+            return self._index[key]
+        return key
+
+    def __getitem__(self, key):
+        self._sync_local()
+        return self._ldata.array.reshape(-1, self.ncomponents)[:,self._component(key)]
+
+    def __setitem__(self, key, value):
+        self._ldata.array.reshape(-1, self.ncomponents)[:,self._component(key)] = value
+        self._ldata.stateIncrease()
+        self._dm.localToGlobal(self._ldata, self._gdata)
+
+
+    @property
+    def array(self):
+        """
+        Local (ghosted) array of shape (n, ncomponents)
+        """
+        self._sync_local()
+        return self._ldata.array.reshape(-1, self.ncomponents)
+
+
+    def sync(self, *args):
+        """
+        Synchronise local fields across all processors in one scatter.
+        Values owned by each processor overwrite their ghost copies.
+
+        Arguments
+        ---------
+         args : local arrays for each component (optional)
+            otherwise the values currently in the local array are used
+
+        Returns
+        -------
+         fields : list of synchronised local arrays (views)
+        """
+        if args:
+            if len(args) != self.ncomponents:
+                raise ValueError("expected {} fields, got {}".format(self.ncomponents, len(args)))
+            local = self._ldata.array.reshape(-1, self.ncomponents)
+            for i, arg in enumerate(args):
+                local[:,i] = arg
+
+        self._ldata.stateIncrease()
+        self._dm.localToGlobal(self._ldata, self._gdata)
+        self._sync_local()
+        local = self._ldata.array.reshape(-1, self.ncomponents)
+        return [local[:,i] for i in range(self.ncomponents)]
+
+
+    @contextmanager
+    def local_view(self, readonly=False):
+        """
+        Context manager that returns a NumPy view of the local array
+        of shape (n, ncomponents). Changes are sent to the global
+        vector with one scatter on exit.
+        """
+        self._sync_local()
+        if readonly:
+            yield self._ldata.array_r.reshape(-1, self.ncomponents)
+        else:
+            yield self._ldata.array.reshape(-1, self.ncomponents)
+            self._ldata.stateIncrease()
+            self._dm.localToGlobal(self._ldata, self._gdata)
+
+    @contextmanager
+    def global_view(self, readonly=False):
+        """
+        Context manager that returns a NumPy view of the array
+        owned by this processor of shape (n, ncomponents).
+        """
+        if readonly:
+            yield self._gdata.array_r.reshape(-1, self.ncomponents)
+        else:
+            yield self._gdata.array.reshape(-1, self.ncomponents)
+            self._gdata.stateIncrease()
+
+    def getGlobal(self):
+        return self._gdata
+
+    def getLocal(self):
+        return self._ldata
+
+
+def _sync_local(var):
+    """
+    Refresh the local vector of a MeshVariable or MeshVariableBundle
+    if the global or local vector has changed on any processor
+    """
+    state = (var._gdata.stateGet(), var._ldata.stateGet())
+    if var._comm.allreduce(state != var._state, op=MPI.LOR):
+        var._dm.globalToLocal(var._gdata, var._ldata)
+        var._state = (var._gdata.stateGet(), var._ldata.stateGet())
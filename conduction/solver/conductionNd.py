@@ -24,8 +24,9 @@ from petsc4py import PETSc
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
 
-from ..tools import sum_duplicates
-from ..mesh import MeshVariable
+from ..tools import sum_duplicates_index, AsyncWriter
+from ..mesh import MeshVariable, MeshVariableBundle
+from .matrix_free import StencilMatrix
 
 class ConductionND(object):
     """
@@ -37,6 +38,12 @@ class ConductionND(object):
      minCoord : tuple, minimum Cartesian coordinates at edge of domain
      maxCoord : tuple, maximum Cartesian coordinates at edge of domain
      res      : tuple, resolution in each dimension
+     matrix_free : bool, apply the stencil without assembling a matrix
+        (a PETSc MatShell preconditioned with Jacobi by default)
+     symmetric : bool, eliminate Dirichlet columns to give a symmetric
+        positive definite matrix (CG is the default solver)
+     dm       : DMDA object, use an existing grid instead of creating one
+        (minCoord, maxCoord and res are ignored)
      kwargs   : dict, keyword arguments to pass to KSP method and preconditioner
         see PETSc documentaion for KSPType and PCType options...
         http://www.mcs.anl.gov/petsc/petsc-current/docs/manualpages/KSP/KSPType.html
@@ -44,19 +51,25 @@ class ConductionND(object):
     """
     def __init__(self, minCoord, maxCoord, res, **kwargs):
 
-        dim = len(res)
-        extent = np.zeros(dim*2)
+        width = kwargs.pop('stencil_width', 1)
+        dm = kwargs.pop('dm', None)
 
-        index = 0
-        for i in range(0, dim):
-            extent[index]   = minCoord[i]
-            extent[index+1] = maxCoord[i]
-            index += 2
+        if dm is None:
+            dim = len(res)
+            extent = np.zeros(dim*2)
 
-        width = kwargs.pop('stencil_width', 1)
+            index = 0
+            for i in range(0, dim):
+                extent[index]   = minCoord[i]
+                extent[index+1] = maxCoord[i]
+                index += 2
 
-        dm = PETSc.DMDA().create(dim=dim, sizes=res, stencil_width=width, comm=comm)
-        dm.setUniformCoordinates(*extent)
+            dm = PETSc.DMDA().create(dim=dim, sizes=res, stencil_width=width, comm=comm)
+            dm.setUniformCoordinates(*extent)
+        else:
+            dim = dm.getDim()
+            width = dm.getStencilWidth()
+            extent = np.ravel(dm.getBoundingBox())
 
         self.dm = dm
         self.lgmap = dm.getLGMap()
@@ -106,11 +119,35 @@ class ConductionND(object):
         # set matrix and vector types
         self.MatType = kwargs.pop('MatType', 'aij') # cuda, seqaij, mpiaij, etc.
         self.VecType = kwargs.pop('VecType', 'standard')
+        self.matrix_free = kwargs.pop('matrix_free', False)
+        self.symmetric = kwargs.pop('symmetric', False)
+
+        if self.matrix_free and self.symmetric:
+            raise ValueError("symmetric assembly is not available for the matrix-free operator")
 
         self._initialise_mesh_variables()
         self._initialise_boundary_dictionary()
-        self.mat = self._initialise_matrix()
         self._initialise_COO_vectors(width)
+        self._geometry_id = 0
+        self._initialise_stencil_geometry()
+        self.mat = self._initialise_matrix()
+
+        # spare matrices recycled by construct_matrix(in_place=False)
+        self._mat_pool = {}
+        self._mat_dirichlet_mask = None
+
+        # nonlinear solver (see solve_nonlinear)
+        self._snes = None
+        self.nonlinear_iterations = 0
+
+        # coarse grids for geometric multigrid (see _initialise_multigrid)
+        self._mg_meshes = []
+        self._mg_interp = []
+        self._mg_restrict = []
+        self._mg_pcs = []
+        self._mg_galerkin_pcs = []
+        self._mg_fine_interp = None
+
         self.ksp = self._initialise_ksp(**kwargs)
 
         # thermal properties
@@ -121,11 +158,22 @@ class ConductionND(object):
         # right hand side vector
         self.rhs = MeshVariable('rhs', dm)
 
+        # work vector for lifting Dirichlet BCs in symmetric mode
+        self._rhs_sym = self.gvec.duplicate()
+        self._lift_weights = (0.0, 0.0)
+        self._lift_scale = (-1.0, 1.0)
+
+        # background HDF5 output (see save_field_to_hdf5)
+        self._async_writer = None
+
 
     def __delete__(self):
 
         del self.rhs, self.diffusivity, self.heat_sources, self.temperature
         self.mat.destroy()
+        for pool in self._mat_pool.values():
+            for mat in pool:
+                mat.destroy()
         self.dm.destroy()
         self.lvec.destroy()
         self.gvec.destroy()
@@ -135,24 +183,277 @@ class ConductionND(object):
     def _initialise_ksp(self, matrix=None, atol=1e-10, rtol=1e-50, **kwargs):
         """
         Initialise linear solver object
+
+        The DMDA is attached to the KSP so that multigrid preconditioners
+        can build a grid hierarchy. Setting pc='mg' does this automatically
+        and accepts two extra keyword arguments:
+         mg_levels   : int, number of grid levels (default is the maximum)
+         mg_galerkin : bool, form coarse operators by the Galerkin product
+            (default) or rediscretise them from a restricted diffusivity
         """
         if matrix is None:
             matrix = self.mat
 
-        solver = kwargs.pop('solver', 'gmres')
-        precon = kwargs.pop('pc', None)
+        default_solver, default_pc = self._get_default_solver()
+        solver = kwargs.pop('solver', default_solver)
+        precon = kwargs.pop('pc', default_pc)
+        mg_levels = kwargs.pop('mg_levels', None)
+        mg_galerkin = kwargs.pop('mg_galerkin', True)
 
         ksp = PETSc.KSP().create(comm)
         ksp.setType(solver)
         ksp.setOperators(matrix)
         ksp.setTolerances(atol, rtol)
+        self._set_ksp_dm(ksp, self.dm)
         if precon is not None:
             pc = ksp.getPC()
             pc.setType(precon)
+            if precon == 'mg':
+                self._initialise_multigrid(pc, mg_levels, mg_galerkin)
         ksp.setFromOptions()
         return ksp
 
 
+    def _get_default_solver(self):
+        """
+        Default KSP and PC types for the type of matrix
+        """
+        if self.matrix_free:
+            return 'gmres', 'jacobi'
+        elif self.symmetric:
+            # ICC is only available in serial
+            return 'cg', 'icc' if comm.size == 1 else 'gamg'
+        else:
+            return 'gmres', None
+
+
+    @staticmethod
+    def _set_ksp_dm(ksp, dm):
+        """
+        Attach a DM to a KSP without letting it compute the operators
+        """
+        ksp.setDM(dm)
+        try:
+            ksp.setDMActive(PETSc.KSP.DMActive.ALL, False)
+        except (AttributeError, TypeError):
+            # petsc4py < 3.23
+            ksp.setDMActive(False)
+
+
+    def _get_multigrid_levels(self):
+        """
+        Find the maximum number of grid levels.
+        Each coarsening halves the number of intervals, so (M - 1) must be
+        divisible by 2 in every dimension and each processor should keep
+        at least two nodes per dimension.
+        """
+        sizes = self.dm.getSizes()
+
+        local_size = np.array(float(min([e - s for s, e in self.dm.getRanges()])))
+        global_size = np.array(0.0)
+        comm.Allreduce([local_size, MPI.DOUBLE], [global_size, MPI.DOUBLE], op=MPI.MIN)
+
+        levels = 1
+        factor = 2
+        while True:
+            for M in sizes:
+                if (M - 1) % factor or (M - 1)//factor < 2:
+                    return levels
+            if global_size//factor < 2:
+                return levels
+            levels += 1
+            factor *= 2
+
+
+    def _initialise_multigrid(self, pc, levels=None, galerkin=True):
+        """
+        Set up geometric multigrid (PCMG) on the DMDA hierarchy.
+
+        With Galerkin coarsening PETSc coarsens the DM attached to the KSP
+        and forms the coarse operators as P^T A P. The rows of Dirichlet
+        nodes are removed from the finest interpolation so the identity
+        rows of A do not leak into the coarse operators.
+        Otherwise a ConductionND object is created on each coarse DM and
+        the coarse operators are rediscretised from a restricted diffusivity
+        field every time the matrix is constructed (see _update_multigrid).
+
+        Each level is smoothed with Richardson/SOR, which can be changed
+        with the -mg_levels_ksp_type and -mg_levels_pc_type options.
+
+        Arguments
+        ---------
+         pc       : PETSc PC object
+         levels   : int, number of grid levels (including the finest)
+         galerkin : bool, use Galerkin coarse grid operators
+        """
+        if self.matrix_free:
+            raise ValueError("multigrid requires an assembled matrix")
+
+        max_levels = self._get_multigrid_levels()
+        if levels is None:
+            levels = max_levels
+        elif levels > max_levels:
+            raise ValueError("The grid can only be coarsened to {} levels".format(max_levels))
+
+        pc.setType('mg')
+        pc.setMGLevels(levels)
+
+        # the default Chebyshev smoother relies on eigenvalue estimates
+        # that fail for the nonsymmetric (lifted) operator in parallel
+        for i in range(1, levels):
+            smoother = pc.getMGSmoother(i)
+            smoother.setType('richardson')
+            smoother.getPC().setType('sor')
+
+        if galerkin:
+            if self._mg_fine_interp is None:
+                P, rscale = self.dm.coarsen().createInterpolation(self.dm)
+                rscale.destroy()
+                self._mg_fine_interp = (P, self._create_masked_transfer(P), None)
+
+            pc.setMGInterpolation(levels - 1, self._mg_fine_interp[1])
+            self._mg_galerkin_pcs.append(pc)
+
+            opts = PETSc.Options(pc.getOptionsPrefix())
+            opts.setValue('pc_mg_galerkin', 'both')
+            pc.setFromOptions()
+            opts.delValue('pc_mg_galerkin')
+            return
+
+        # create the coarse grids once and share them between solvers
+        if len(self._mg_meshes) + 1 < levels:
+            self._mg_meshes = []
+            self._mg_interp = []
+            self._mg_restrict = []
+
+            kwargs = {'MatType': self.MatType, 'VecType': self.VecType,
+                      'symmetric': self.symmetric}
+            dm_hierarchy = self.dm.coarsenHierarchy(levels - 1)[::-1]
+            dm_hierarchy.append(self.dm)
+
+            for i in range(0, levels - 1):
+                dmc, dmf = dm_hierarchy[i], dm_hierarchy[i+1]
+                self._mg_meshes.append(ConductionND(None, None, None, dm=dmc, **kwargs))
+
+                # full weighting restriction R = P^T / 2^dim
+                P, rscale = dmc.createInterpolation(dmf)
+                R = P.transpose(PETSc.Mat())
+                R.scale(0.5**self.dim)
+                self._mg_interp.append((P, rscale))
+                self._mg_restrict.append((R, self._create_masked_transfer(R), None))
+
+        # use the finest grids of an existing hierarchy
+        offset = len(self._mg_meshes) - (levels - 1)
+        meshes = self._mg_meshes[offset:]
+        interp = self._mg_interp[offset:]
+
+        for i in range(0, levels - 1):
+            P, rscale = interp[i]
+            pc.setMGInterpolation(i+1, P)
+
+        self._mg_pcs.append((pc, levels - 1))
+        self._set_multigrid_operators()
+
+
+    @staticmethod
+    def _create_masked_transfer(mat):
+        """
+        Copy of a grid transfer operator whose rows are zeroed at
+        Dirichlet nodes (see _mask_transfer).
+        The nonzero pattern is kept so it can be updated in place.
+        """
+        masked = mat.copy()
+        masked.setOption(PETSc.Mat.Option.KEEP_NONZERO_PATTERN, True)
+        return masked
+
+
+    def _mask_transfer(self, transfer, mesh):
+        """
+        Zero the rows of a masked transfer operator at the Dirichlet nodes
+        of mesh. The entries are only refilled when the Dirichlet nodes
+        change on any processor.
+
+        Arguments
+        ---------
+         transfer : (template, masked, mask) tuple
+         mesh     : ConductionND object on the grid of the rows
+
+        Returns
+        -------
+         transfer : updated (template, masked, mask) tuple
+        """
+        template, masked, mask = transfer
+        dirichlet_mask = mesh.dirichlet_mask
+
+        changed = mask is None or not np.array_equal(mask, dirichlet_mask)
+        if not comm.allreduce(changed, op=MPI.LOR):
+            return transfer
+
+        rows = np.nonzero(dirichlet_mask)[0].astype(PETSc.IntType)
+        template.copy(masked, structure=PETSc.Mat.Structure.SAME)
+        masked.zeroRows(mesh.lgmap.apply(rows), diag=0.0)
+        return template, masked, dirichlet_mask.copy()
+
+
+    def _set_multigrid_operators(self):
+        """
+        Point the smoothers of each multigrid level at the coarse operators
+        and set the restriction of the residual
+        """
+        for pc, ncoarse in self._mg_pcs:
+            offset = len(self._mg_meshes) - ncoarse
+            meshes = self._mg_meshes[offset:]
+            restrict = self._mg_restrict[offset:]
+            for i, mesh in enumerate(meshes):
+                smoother = pc.getMGSmoother(i)
+                smoother.setOperators(mesh.mat)
+                self._set_ksp_dm(smoother, mesh.dm)
+                pc.setMGRestriction(i+1, restrict[i][1])
+
+
+    def _update_multigrid(self):
+        """
+        Update the multigrid grid transfer and coarse grid operators.
+
+        With Galerkin coarsening the finest interpolation is masked at the
+        Dirichlet nodes and PETSc recomputes the coarse operators.
+
+        Otherwise the coarse operators are rediscretised.
+        Diffusivity is restricted to each coarse grid by a weighted average
+        (P^T k scaled by the row sums of P^T) and nodes along Dirichlet walls
+        are mirrored from the fine grid. The residual is restricted by full
+        weighting except at coarse Dirichlet nodes, where it is zero so that
+        the coarse grid correction leaves the boundary values alone.
+        """
+        if self._mg_fine_interp is not None:
+            self._mg_fine_interp = self._mask_transfer(self._mg_fine_interp, self)
+
+        if not self._mg_meshes:
+            return
+
+        walls = [wall for wall in self.bc if not self.bc[wall]['flux']]
+
+        kf = self.diffusivity._gdata
+        for i in range(len(self._mg_meshes) - 1, -1, -1):
+            mesh = self._mg_meshes[i]
+            P, rscale = self._mg_interp[i]
+
+            kc = mesh.diffusivity._gdata
+            P.multTranspose(kf, kc)
+            kc.pointwiseMult(kc, rscale)
+
+            mesh.dirichlet_mask.fill(False)
+            for wall in walls:
+                mesh.dirichlet_mask[mesh.bc[wall]['mask']] = True
+
+            mesh.construct_matrix()
+            kf = kc
+
+            self._mg_restrict[i] = self._mask_transfer(self._mg_restrict[i], mesh)
+
+        self._set_multigrid_operators()
+
+
     def _initialise_COO_vectors(self, pad=1):
 
         nn = self.nn
@@ -165,6 +466,105 @@ class ConductionND(object):
         self.vals = np.empty((self.stencil_width, nn))
 
 
+    def _initialise_stencil_geometry(self):
+        """
+        Cache the parts of the stencil that only depend on the mesh geometry.
+        These are reused every time the matrix is constructed and must be
+        rebuilt whenever the coordinates change (see refine).
+
+        Stores
+        ------
+         _stencil_obj     : list of slicing tuples into the padded mesh
+         _stencil_cols    : column indices for each arm of the stencil
+         _stencil_offgrid : mask of stencil arms that fall off the grid
+         _stencil_delta   : inverse-distance weights 1/(2*distance**2)
+            (zeroed for the centre node and off-grid arms)
+         _geometry_id     : counter that changes with the geometry
+        """
+        nn = self.nn
+        index = self.index
+
+        obj = []
+        cols = np.empty((self.stencil_width, nn), dtype=PETSc.IntType)
+        delta = np.empty((self.stencil_width, nn))
+
+        for i in range(0, self.stencil_width):
+            obj.append(tuple(self.closure[i]))
+            cols[i] = index[obj[i]].ravel()
+
+            distance = np.linalg.norm(self.coords[cols[i]] - self.coords, axis=1)
+            distance[distance==0] = 1e-12 # protect against dividing by zero
+            delta[i] = 1.0/(2.0*distance**2)
+
+        offgrid = cols < 0
+
+        # zero off-grid coordinates and the centre point
+        delta[offgrid] = 0.0
+        delta[-1] = 0.0
+
+        self._stencil_obj = obj
+        self._stencil_cols = cols
+        self._stencil_offgrid = offgrid
+        self._stencil_delta = delta
+        self._geometry_id += 1
+
+        # sparsity pattern is derived from the stencil
+        self._csr_pattern = None
+
+
+    def _initialise_sparsity_pattern(self):
+        """
+        Compute the CSR structure of the matrix for the current set of
+        Dirichlet boundary conditions.
+
+        The sparsity pattern does not change between calls to construct_matrix
+        unless the Dirichlet mask changes, so we store the permutation that
+        sorts the stencil into CSR order and the indices that sum duplicate
+        entries. The matrix values are then refilled with a single gather
+        and np.add.reduceat.
+        """
+        nodes = self.nodes
+        dirichlet_mask = self.dirichlet_mask.copy()
+
+        rows = self.rows
+        cols = self.cols
+
+        rows[:] = nodes
+        cols[:] = self._stencil_cols
+
+        # Dirichlet boundary conditions (duplicates are summed)
+        cols[:,dirichlet_mask] = nodes[dirichlet_mask]
+
+        row = rows.ravel()
+        col = cols.ravel()
+
+        # mask off-grid entries and sum duplicates
+        mask, = np.nonzero(col >= 0)
+        order, unique_inds = sum_duplicates_index(row[mask], col[mask])
+        perm = mask[order]
+
+        row = row[perm][unique_inds]
+        col = col[perm][unique_inds]
+
+        nnz = np.bincount(row, minlength=self.nn)
+        indptr = np.insert(np.cumsum(nnz),0,0).astype(PETSc.IntType)
+
+        self._csr_pattern = (dirichlet_mask, perm, unique_inds, indptr, col)
+
+        # stencil arms that point to a Dirichlet node
+        self._stencil_dirichlet = dirichlet_mask[self._stencil_cols] & ~self._stencil_offgrid
+
+
+    def _get_sparsity_pattern(self):
+        """
+        Return the CSR structure of the matrix.
+        This is only recomputed if the Dirichlet BCs change.
+        """
+        pattern = self._csr_pattern
+        if pattern is None or not np.array_equal(pattern[0], self.dirichlet_mask):
+            self._initialise_sparsity_pattern()
+        return self._csr_pattern
+
 
     def _initialise_mesh_variables(self):
 
@@ -228,8 +628,21 @@ class ConductionND(object):
 
         Could push zeros into the matrix to allocate all potential entries
         but that would lengthen the build stage.
+
+        Rows of the stencil are complete for every owned node, so entries
+        inserted for ghost nodes are dropped during assembly. This keeps
+        truncated rows at the edge of the ghost region out of the matrix
+        (only for the default stencil preallocation).
+
+        If matrix_free is enabled a MatShell is returned instead.
         """
-        if nnz is None:
+        if self.matrix_free:
+            mat = PETSc.Mat().createPython(self.sizes, StencilMatrix(self), comm=comm)
+            mat.setUp()
+            return mat
+
+        stencil = nnz is None
+        if stencil:
             nnz = (self.stencil_width, self.dim*2)
 
         mat = PETSc.Mat().create(comm=comm)
@@ -238,10 +651,41 @@ class ConductionND(object):
         mat.setLGMap(self.lgmap)
         mat.setPreallocationNNZ(nnz)
         mat.setOption(PETSc.Mat.Option.NEW_NONZERO_ALLOCATION_ERR, 0)
+        if stencil:
+            mat.setOption(PETSc.Mat.Option.IGNORE_OFF_PROC_ENTRIES, True)
         mat.setFromOptions()
         
         return mat
 
+
+    def _get_matrix(self, nnz=None):
+        """
+        Take a matrix from the pool or allocate a new one if it is empty
+        """
+        pool = self._mat_pool.get((self.MatType, nnz), [])
+        if pool:
+            return pool.pop()
+        return self._initialise_matrix(nnz)
+
+
+    def release_matrix(self, mat, nnz=None):
+        """
+        Return a matrix created by construct_matrix(in_place=False) so
+        that it can be recycled by the next call. The entries are zeroed
+        but the nonzero structure is retained.
+
+        Arguments
+        ---------
+         mat : PETSc Mat object
+         nnz : preallocation of the matrix (if not the default)
+        """
+        if mat is self.mat:
+            raise ValueError("Cannot release the matrix owned by the mesh")
+
+        if mat.isAssembled():
+            mat.zeroEntries()
+        self._mat_pool.setdefault((self.MatType, nnz), []).append(mat)
+
     def _initialise_vector(self, sizes):
 
         vec = PETSc.Vec().create(comm=comm)
@@ -308,12 +752,26 @@ class ConductionND(object):
 
         self._initialise_mesh_variables()
         self._initialise_boundary_dictionary()
-        self.mat = self._initialise_matrix()
+        self._initialise_stencil_geometry()
+
+        # the sparsity is unchanged so the matrix is kept
+        # (entries are refilled by construct_matrix)
+
+        # coarse grids inherit the same coordinate transformation
+        for mesh in self._mg_meshes:
+            mesh.refine(fn, axis)
 
 
     def create_meshVariable(self, name):
         return MeshVariable(name, self.dm)
 
+    def create_meshVariableBundle(self, *names):
+        """
+        Create variables that are exchanged between processors
+        together in one scatter (see MeshVariableBundle)
+        """
+        return MeshVariableBundle(names, self.dm)
+
 
     def update_properties(self, diffusivity, heat_sources):
         """
@@ -397,84 +855,154 @@ class ConductionND(object):
         Neumann (flux) boundary creation.
         These are stomped on if there are any Dirichlet conditions.
 
+        Distances between nodes are cached in _initialise_stencil_geometry
+        so only the diffusivity is evaluated on each call.
+
+        In symmetric mode the Dirichlet columns are also eliminated and the
+        sign is flipped to give a symmetric positive definite matrix.
+        Their contribution is lifted to the rhs in solve. Derivative
+        matrices are always constructed in full.
+
+        Matrices created with in_place=False can be handed back with
+        release_matrix to be recycled.
         """
 
         if in_place:
             mat = self.mat
+            if not derivative:
+                self._update_multigrid()
         else:
-            mat = self._initialise_matrix()
+            mat = self._get_matrix()
 
-        nodes = self.nodes
-        nn = self.nn
-        n = self.n
-        dim = self.dim
+        if self.matrix_free:
+            return self._construct_matrix_free(mat, derivative)
 
-        index = self.index
-
-        rows = self.rows
-        cols = self.cols
+        n = self.n
         vals = self.vals
 
         dirichlet_mask = self.dirichlet_mask
 
+        _, perm, unique_inds, indptr, col = self._get_sparsity_pattern()
+
+        # clear entries that fall outside the current sparsity pattern
+        if in_place:
+            if self._mat_dirichlet_mask is not None and \
+               not np.array_equal(self._mat_dirichlet_mask, dirichlet_mask):
+                mat.zeroEntries()
+            self._mat_dirichlet_mask = dirichlet_mask.copy()
+
         u = self.diffusivity[:].reshape(n)
         k = np.pad(u, self.width, 'constant', constant_values=0)
 
-        for i in range(0, self.stencil_width):
-            obj = tuple(self.closure[i])
-
-            rows[i] = nodes
-            cols[i] = index[obj].ravel()
+        # off-grid coordinates and the centre point have zero weight
+        delta = self._stencil_delta
 
-            distance = np.linalg.norm(self.coords[cols[i]] - self.coords, axis=1)
-            distance[distance==0] = 1e-12 # protect against dividing by zero
-            delta = 1.0/(2.0*distance**2)
+        for i in range(0, self.stencil_width):
+            obj = self._stencil_obj[i]
+            vals[i] = delta[i]*(k[obj] + u).ravel()
 
-            vals[i] = delta*(k[obj] + u).ravel()
+        symmetric = self.symmetric and not derivative
+        if symmetric:
+            self._initialise_lift(vals)
 
 
-        # Dirichlet boundary conditions (duplicates are summed)
-        cols[:,dirichlet_mask] = nodes[dirichlet_mask]
+        # Dirichlet boundary conditions
         vals[:,dirichlet_mask] = 0.0
 
-        # zero off-grid coordinates
-        vals[cols < 0] = 0.0
-
-        # centre point
-        vals[-1] = 0.0
-        if derivative:
+        if symmetric:
+            # Dirichlet columns are eliminated but still count towards the diagonal
+            vals[-1] = -vals[:-1].sum(axis=0)
+            vals[:-1][self._stencil_dirichlet[:-1]] = 0.0
+            vals[-1][dirichlet_mask] = -1.0
+            vals *= -1.0
+        elif derivative:
             vals[-1][dirichlet_mask] = 0.
         else:
             vals[-1][dirichlet_mask] = -1.0
 
 
-        row = rows.ravel()
-        col = cols.ravel()
-        val = vals.ravel()
+        # gather into CSR order and sum duplicates
+        val = np.add.reduceat(vals.ravel()[perm], unique_inds)
 
 
-        # mask off-grid entries and sum duplicates
-        mask = col >= 0
-        row, col, val = sum_duplicates(row[mask], col[mask], val[mask])
+        mat.assemblyBegin()
+        mat.setValuesLocalCSR(indptr, col, val)
+        mat.assemblyEnd()
+
+        if not symmetric:
+            # set diagonal vector
+            diag = mat.getRowSum()
+            diag.scale(-1.0)
+            mat.setDiagonal(diag)
 
+        return mat
 
-        # indptr, col, val = coo_tocsr(row, col, val)
-        nnz = np.bincount(row)
-        indptr = np.insert(np.cumsum(nnz),0,0)
 
+    def _initialise_lift(self, vals):
+        """
+        Store the entries of the Dirichlet columns that are eliminated
+        from the symmetric matrix.
+
+         _lift_weights : (A_ND, A_DN) stored per stencil arm
+            A_ND couples free rows to Dirichlet columns (forward solve)
+            A_DN couples Dirichlet rows to free columns (transpose solve)
+         _lift_scale   : (sigma, lambda) where the symmetric matrix
+            S = sigma*A_NN and the original matrix has A_ND scaled by lambda
+        """
+        dirichlet_mask = self.dirichlet_mask
+        stencil_dirichlet = self._stencil_dirichlet[:-1]
+        weights = vals[:-1]
 
-        mat.assemblyBegin()
-        mat.setValuesLocalCSR(indptr.astype(PETSc.IntType), col, val)
-        mat.assemblyEnd()
+        lift   = np.where(stencil_dirichlet & ~dirichlet_mask, weights, 0.0)
+        lift_T = np.where(~stencil_dirichlet & dirichlet_mask, weights, 0.0)
+
+        self._lift_weights = (lift, lift_T)
+        self._lift_scale = (-1.0, 1.0)
 
-        # set diagonal vector
-        diag = mat.getRowSum()
-        diag.scale(-1.0)
-        mat.setDiagonal(diag)
 
+    def _construct_matrix_free(self, mat, derivative=False):
+        """
+        Update the stencil weights of a matrix-free operator.
+        The same entries as construct_matrix are computed but stored
+        per stencil arm in the shape of the mesh rather than assembled.
+        """
+        dirichlet_mask = self.dirichlet_mask
+        weights = self._stencil_weights()
+
+        # Jacobi preconditioner is taken straight from the diagonal
+        diag = -weights.sum(axis=0).ravel()
+
+        # Dirichlet boundary conditions
+        if derivative:
+            diag[dirichlet_mask] = 0.0
+        else:
+            diag[dirichlet_mask] = 1.0
+
+        mat.getPythonContext().update(weights, ~dirichlet_mask, diag)
+        mat.assemble() # bump the object state so the PC is rebuilt
         return mat
 
 
+    def _stencil_weights(self):
+        """
+        Off-diagonal weights delta*(k_i + k_j) for each arm of the stencil
+        in the shape of the mesh (the centre node is excluded)
+        """
+        n = self.n
+
+        u = self.diffusivity[:].reshape(n)
+        k = np.pad(u, self.width, 'constant', constant_values=0)
+
+        delta = self._stencil_delta
+        weights = np.empty((self.stencil_width-1,) + tuple(n))
+
+        for i in range(0, self.stencil_width-1):
+            obj = self._stencil_obj[i]
+            weights[i] = delta[i].reshape(n)*(k[obj] + u)
+
+        return weights
+
+
     def construct_rhs(self, in_place=True):
         """
         Construct the right-hand-side vector
@@ -489,18 +1017,18 @@ class ConductionND(object):
         else:
             rhs = MeshVariable('rhs', self.dm)
         
-        vec = -1.0*self.heat_sources[:]
+        with self.heat_sources.local_view(readonly=True) as H, rhs.local_view() as vec:
+            np.negative(H, out=vec)
+
+            for wall in self.bc:
+                val  = self.bc[wall]['val']
+                flux = self.bc[wall]['flux']
+                mask = self.bc[wall]['mask']
+                if flux:
+                    vec[mask] += val
+                else:
+                    vec[mask] = val
 
-        for wall in self.bc:
-            val  = self.bc[wall]['val']
-            flux = self.bc[wall]['flux']
-            mask = self.bc[wall]['mask']
-            if flux:
-                vec[mask] += val
-            else:
-                vec[mask] = val
-
-        rhs[:] = vec
         return rhs
 
 
@@ -519,11 +1047,356 @@ class ConductionND(object):
 
         ksp = self.ksp
         ksp.setOperators(matrix)
-        ksp.solve(rhs._gdata, res._gdata)
+        self._solve(ksp, rhs, res._gdata)
         # We should hand this back to local vectors
         return res[:]
 
 
+    def _solve(self, ksp, rhs, res, transpose=False):
+        """
+        Solve Ax = b, or A^T x = b, with the operator attached to ksp.
+
+        In symmetric mode the matrix is S = sigma*A_NN with the Dirichlet
+        nodes decoupled, so boundary values are lifted to the rhs
+            S x_N = sigma*(b_N - lambda*A_ND b_D),  x_D = b_D
+        and the transpose is the same solve followed by
+            x_D = b_D - lambda*A_DN x_N
+
+        Arguments
+        ---------
+         ksp       : PETSc KSP object
+         rhs       : MeshVariable, right hand side vector b
+         res       : PETSc global Vec, solution vector x
+         transpose : bool, solve the transposed system
+        """
+        if not self.symmetric:
+            if transpose:
+                ksp.solveTranspose(rhs._gdata, res)
+            else:
+                ksp.solve(rhs._gdata, res)
+            return res
+
+        lift, lift_T = self._lift_weights
+        sigma, lam = self._lift_scale
+        cols = self._stencil_cols[:-1]
+        dirichlet_mask = self.dirichlet_mask
+
+        b = rhs[:]
+
+        if transpose:
+            vec = sigma*b
+            vec[dirichlet_mask] = 0.0
+        else:
+            vec = sigma*(b - lam*(lift*b[cols]).sum(axis=0))
+            vec[dirichlet_mask] = b[dirichlet_mask]
+
+        self.lvec.setArray(vec)
+        self.dm.localToGlobal(self.lvec, self._rhs_sym)
+        ksp.solve(self._rhs_sym, res)
+
+        if transpose:
+            self.dm.globalToLocal(res, self.lvec)
+            x = self.lvec.array
+            x_D = b - lam*(lift_T*x[cols]).sum(axis=0)
+            x[dirichlet_mask] = x_D[dirichlet_mask]
+            self.dm.localToGlobal(self.lvec, res)
+
+        return res
+
+
+    def solve_nonlinear(self, k_fn, dk_dT_fn=None, method='newton', rhs=None,
+                        rtol=1e-10, tolerance=1e-5, max_it=50):
+        """
+        Solve the steady-state heat equation where diffusivity is a
+        function of temperature, k = k_fn(T).
+
+        A linear solve with the current diffusivity provides the initial
+        guess. Newton's method (PETSc SNES) then uses the analytic Jacobian
+            J = A(k) + (dA/dk T) diag(dk/dT)
+        and converges quadratically. Picard iteration, where the matrix is
+        rebuilt with k = k_fn(T) after every linear solve, is used if
+        dk_dT_fn is not given or as a fallback if Newton's method does not
+        converge. The Jacobian is only available for an assembled matrix,
+        so the matrix-free operator requires method='picard'.
+
+        Arguments
+        ---------
+         k_fn      : function, diffusivity for an array of temperatures
+         dk_dT_fn  : function, derivative of k_fn w.r.t. temperature
+         method    : str, 'newton' (default) or 'picard'
+         rhs       : MeshVariable, right hand side vector
+            (default is to call construct_rhs)
+         rtol      : float, relative reduction of the residual (Newton)
+         tolerance : float, maximum change in diffusivity (Picard)
+         max_it    : int, maximum number of iterations
+
+        Returns
+        -------
+         T : ndarray shape(n,) temperature
+
+        Notes
+        -----
+         The diffusivity field is updated to k_fn(T) on exit and the number
+         of iterations is stored in nonlinear_iterations.
+        """
+        if method not in ('newton', 'picard'):
+            raise ValueError("method should be one of 'newton' or 'picard'")
+        if method == 'newton' and dk_dT_fn is not None and self.matrix_free:
+            raise ValueError("Newton's method requires an assembled matrix, "
+                             "use method='picard' with matrix_free=True")
+
+        if rhs is None:
+            rhs = self.construct_rhs()
+
+        T0 = self.solve(rhs=rhs).copy()
+
+        converged = False
+        if method == 'newton' and dk_dT_fn is not None:
+            converged = self._solve_newton(k_fn, dk_dT_fn, rhs, rtol, max_it)
+
+        if converged:
+            T = self.temperature[:]
+        else:
+            self.temperature[:] = T0
+            T = self._solve_picard(k_fn, rhs, tolerance, max_it)
+
+        self.diffusivity[:] = k_fn(T)
+        return T
+
+
+    def _initialise_snes(self):
+        """
+        Create the nonlinear solver, Jacobian and work vectors on first use
+        """
+        if self._snes is None:
+            if self.matrix_free:
+                raise ValueError("Newton's method requires an assembled matrix")
+
+            snes = PETSc.SNES().create(comm)
+            snes.setType('newtonls')
+            self._snes = snes
+            self._snes_jacobian = self._get_matrix()
+            self._snes_residual = self.gvec.duplicate()
+            self._snes_solution = self.gvec.duplicate()
+            self._snes_lvec = self.lvec.duplicate()
+            self._snes_lres = self.lvec.duplicate()
+        return self._snes
+
+
+    def _solve_newton(self, k_fn, dk_dT_fn, rhs, rtol, max_it):
+        """
+        Newton iterations with PETSc SNES starting from the current
+        temperature. Returns True if SNES has converged.
+        """
+        snes = self._initialise_snes()
+        lvec = self._snes_lvec
+        lres = self._snes_lres
+        b = rhs[:]
+
+        def residual(snes, X, F):
+            self.dm.globalToLocal(X, lvec)
+            T = lvec.array
+            lres.setArray(self._nonlinear_residual(T, k_fn(T), b))
+            self.dm.localToGlobal(lres, F)
+
+        def jacobian(snes, X, J, P):
+            self.dm.globalToLocal(X, lvec)
+            T = lvec.array
+            self._construct_jacobian(P, T, k_fn(T), dk_dT_fn(T))
+
+        snes.setFunction(residual, self._snes_residual)
+        snes.setJacobian(jacobian, self._snes_jacobian)
+        snes.setTolerances(rtol=rtol, max_it=max_it)
+        snes.setFromOptions()
+        snes.solve(None, self.temperature._gdata)
+
+        self.nonlinear_iterations = snes.getIterationNumber()
+        return snes.getConvergedReason() > 0
+
+
+    def solve_nonlinear_ad(self, T, dT, k_fn, dk_dT_fn):
+        """
+        Adjoint of solve_nonlinear by the implicit function theorem.
+
+        The converged temperature satisfies F(T, k(T)) = A(k(T))T - b = 0
+        so a single transpose solve with the Jacobian at T gives
+        lambda = J^-T dT. Only the converged state is needed and memory
+        does not grow with the number of nonlinear iterations.
+        The Jacobian must be assembled, so this is not available with
+        matrix_free=True.
+
+        Arguments
+        ---------
+         T        : ndarray shape(n,) converged temperature
+         dT       : ndarray shape(n,) derivative of the objective w.r.t. T
+         k_fn     : function, diffusivity for an array of temperatures
+         dk_dT_fn : function, derivative of k_fn w.r.t. temperature
+
+        Returns
+        -------
+         dk : ndarray shape(n,) gradient w.r.t. diffusivity at fixed T
+            (chain this with the derivatives of k_fn w.r.t. its parameters)
+         db : ndarray shape(n,) gradient w.r.t. the rhs vector
+        """
+        if self.matrix_free:
+            raise ValueError("The nonlinear adjoint requires an assembled Jacobian, "
+                             "it is not available with matrix_free=True")
+
+        snes = self._initialise_snes()
+        jac = self._construct_jacobian(self._snes_jacobian, T, k_fn(T), dk_dT_fn(T))
+
+        rhs = self._snes_residual
+        res = self._snes_solution
+
+        self.lvec.setArray(dT)
+        self.dm.localToGlobal(self.lvec, rhs)
+
+        ksp = snes.getKSP()
+        ksp.setOperators(jac)
+        ksp.solveTranspose(rhs, res)
+
+        self.dm.globalToLocal(res, self.lvec)
+        db = self.lvec.array.copy()
+        dk = self.diffusivity_sensitivity(T, db)
+        return dk, db
+
+
+    def _solve_picard(self, k_fn, rhs, tolerance, max_it):
+        """
+        Picard iterations starting from the current temperature
+        """
+        T = self.temperature[:]
+        k_last = self.diffusivity[:]
+
+        error = np.array(0.0)
+        for i in range(0, max_it):
+            k = k_fn(T)
+            local_error = np.array(np.absolute(k - k_last).max())
+            comm.Allreduce([local_error, MPI.DOUBLE], [error, MPI.DOUBLE], op=MPI.MAX)
+            if error < tolerance:
+                break
+
+            self.diffusivity[:] = k
+            T = self.solve(rhs=rhs)
+            k_last = k
+
+        self.nonlinear_iterations = i + 1
+        return T
+
+
+    def _nonlinear_residual(self, T, k, b):
+        """
+        Residual of the steady-state heat equation F(T) = A(k)T - b
+        on the local domain (ghost nodes at the edge are incomplete)
+        """
+        n = self.n
+        dirichlet_mask = self.dirichlet_mask
+
+        T0 = T.reshape(n)
+        k0 = k.reshape(n)
+        Tpad = np.pad(T0, self.width, 'constant', constant_values=0)
+        kpad = np.pad(k0, self.width, 'constant', constant_values=0)
+
+        delta = self._stencil_delta
+
+        F = np.zeros(n)
+        for i in range(0, self.stencil_width - 1):
+            obj = self._stencil_obj[i]
+            F += delta[i].reshape(n)*(kpad[obj] + k0)*(Tpad[obj] - T0)
+
+        F = F.ravel() - b
+        F[dirichlet_mask] = T[dirichlet_mask] - b[dirichlet_mask]
+        return F
+
+
+    def _construct_jacobian(self, mat, T, k, dkdT):
+        """
+        Construct the Jacobian of the nonlinear residual
+
+            J_ij = delta_ij*(k_i + k_j) + delta_ij*(T_j - T_i)*dk_j/dT_j
+            J_ii = sum_j -delta_ij*(k_i + k_j) + delta_ij*(T_j - T_i)*dk_i/dT_i
+
+        with identity rows for Dirichlet nodes.
+        """
+        n = self.n
+        vals = self.vals
+        dirichlet_mask = self.dirichlet_mask
+
+        _, perm, unique_inds, indptr, col = self._get_sparsity_pattern()
+
+        T0 = T.reshape(n)
+        k0 = k.reshape(n)
+        Tpad = np.pad(T0, self.width, 'constant', constant_values=0)
+        kpad = np.pad(k0, self.width, 'constant', constant_values=0)
+        dpad = np.pad(dkdT.reshape(n), self.width, 'constant', constant_values=0)
+
+        delta = self._stencil_delta
+
+        vals[-1] = 0.0
+        for i in range(0, self.stencil_width - 1):
+            obj = self._stencil_obj[i]
+            d = delta[i].reshape(n)
+            w  = (d*(kpad[obj] + k0)).ravel()
+            dT = (d*(Tpad[obj] - T0)).ravel()
+            vals[i] = w + dT*dpad[obj].ravel()
+            vals[-1] += dT*dkdT - w
+
+        # Dirichlet boundary conditions
+        vals[:,dirichlet_mask] = 0.0
+        vals[-1][dirichlet_mask] = 1.0
+
+        # gather into CSR order and sum duplicates
+        val = np.add.reduceat(vals.ravel()[perm], unique_inds)
+
+        if mat.isAssembled():
+            mat.zeroEntries()
+        mat.assemblyBegin()
+        mat.setValuesLocalCSR(indptr, col, val)
+        mat.assemblyEnd()
+        return mat
+
+
+    def diffusivity_sensitivity(self, T, lam):
+        """
+        Sensitivity of an objective function to diffusivity at every node
+        given the temperature and the adjoint vector lambda = A^-T dJ/dT
+
+        Row i of A T is sum_j delta_ij*(k_i + k_j)*(T_j - T_i) so
+            dJ/dk_n = -lambda^T (dA/dk_n) T
+                    = -sum_j delta_nj*(T_j - T_n)*(lambda_n - lambda_j)
+        where lambda is zero on Dirichlet nodes (their rows do not depend on k).
+
+        Arguments
+        ---------
+         T   : ndarray shape(n,) temperature
+         lam : ndarray shape(n,) adjoint vector
+
+        Returns
+        -------
+         dk  : ndarray shape(n,) gradient w.r.t. nodal diffusivity
+        """
+        n = self.n
+
+        lam = lam.copy()
+        lam[self.dirichlet_mask] = 0.0
+
+        T0 = T.reshape(n)
+        L0 = lam.reshape(n)
+        Tpad = np.pad(T0, self.width, 'constant', constant_values=0)
+        Lpad = np.pad(L0, self.width, 'constant', constant_values=0)
+
+        # cached 1/(2*distance**2) is zero off-grid
+        delta = self._stencil_delta
+
+        dk = np.zeros(n)
+        for i in range(0, self.stencil_width - 1):
+            obj = self._stencil_obj[i]
+            dk -= delta[i].reshape(n)*(Tpad[obj] - T0)*(L0 - Lpad[obj])
+
+        # stencil is incomplete at the edge of the ghost region
+        return self.sync(dk.ravel())
+
+
     def sync(self, vector):
         """
         Synchronise a vector field across all processors
@@ -651,6 +1524,8 @@ class ConductionND(object):
         if not filename.endswith('.h5'):
             filename += '.h5'
 
+        self.flush_output()
+
         ViewHDF5 = PETSc.Viewer()
         ViewHDF5.createHDF5(filename, mode='w')
         ViewHDF5.view(obj=self.dm)
@@ -682,6 +1557,9 @@ class ConductionND(object):
 
         Pass these as arguments or keyword arguments for
         their names to be saved to the hdf5 file
+
+        Pass blocking=False to write in the background while
+        the solver continues (see flush_output)
         """
         import os.path
 
@@ -693,6 +1571,8 @@ class ConductionND(object):
         # if not os.path.isfile(file):
         #     self.save_mesh_to_hdf5(file)
 
+        blocking = kwargs.pop('blocking', True)
+
         kwdict = kwargs
         for i, arg in enumerate(args):
             key = "arr_{}".format(i)
@@ -703,6 +1583,17 @@ class ConductionND(object):
 
         vec = self.gvec.duplicate()
 
+        if not blocking:
+            fields = []
+            for key in kwdict:
+                self._field_to_global(kwdict[key], vec)
+                fields.append((key, vec.array.copy(), 1))
+            self._get_async_writer().submit(filename, fields)
+            vec.destroy()
+            return
+
+        self.flush_output()
+
         # change mode to append if file already exists
         # set mode to "a" after first write
         if os.path.isfile(filename):
@@ -712,13 +1603,7 @@ class ConductionND(object):
 
 
         for key in kwdict:
-            val = kwdict[key]
-            try:
-                vec.setArray(val)
-            except:
-                self.lvec.setArray(val)
-                self.dm.localToGlobal(self.lvec, vec)
-
+            self._field_to_global(kwdict[key], vec)
             vec.setName(key)
 
             ViewHDF5 = PETSc.Viewer()
@@ -740,6 +1625,9 @@ class ConductionND(object):
 
         Each argument with x,y,z direction tuple
          e.g. Q=(Qx, Qy, Qz)
+
+        Pass blocking=False to write in the background while
+        the solver continues (see flush_output)
         """
         import os.path
 
@@ -747,6 +1635,8 @@ class ConductionND(object):
         if not filename.endswith('.h5'):
             filename += '.h5'
 
+        blocking = kwargs.pop('blocking', True)
+
         kwdict = kwargs
         for i, arg in enumerate(args):
             key = "arr_{}".format(i)
@@ -755,19 +1645,11 @@ class ConductionND(object):
                                   and keyword: {}".format(key))
             kwdict[key] = arg
 
-        # change mode to append if file already exists
-        # set mode to "a" after first write
-        if os.path.isfile(filename):
-            mode = 'a'
-        else:
-            mode = 'w'
-
-
         # This is a flattened dim x n global vector
         gvec = self.dm.getCoordinates().duplicate()
 
-        for key in kwdict:
-            val = np.array(kwdict[key]).T.ravel()
+        def set_vector(val):
+            val = np.array(val).T.ravel()
 
             # vx, vy, vz = kwdict[key]
             # val = np.column_stack([vx, vy, vz]).ravel()
@@ -775,6 +1657,28 @@ class ConductionND(object):
             gvec.assemblyBegin()
             gvec.setValuesLocal(np.arange(val.size, dtype=PETSc.IntType), val)
             gvec.assemblyEnd()
+
+        if not blocking:
+            fields = []
+            for key in kwdict:
+                set_vector(kwdict[key])
+                fields.append((key, gvec.array.copy(), self.dim))
+            self._get_async_writer().submit(filename, fields)
+            gvec.destroy()
+            return
+
+        self.flush_output()
+
+        # change mode to append if file already exists
+        # set mode to "a" after first write
+        if os.path.isfile(filename):
+            mode = 'a'
+        else:
+            mode = 'w'
+
+
+        for key in kwdict:
+            set_vector(kwdict[key])
             gvec.setName(key)
 
             ViewHDF5 = PETSc.Viewer()
@@ -783,4 +1687,30 @@ class ConductionND(object):
             ViewHDF5.destroy()
             mode = "a"
 
-        gvec.destroy()
\ No newline at end of file
+        gvec.destroy()
+
+
+    def _field_to_global(self, val, vec):
+        """
+        Copy a global or local array into a global vector
+        """
+        try:
+            vec.setArray(val)
+        except:
+            self.lvec.setArray(val)
+            self.dm.localToGlobal(self.lvec, vec)
+
+
+    def _get_async_writer(self):
+        if self._async_writer is None:
+            self._async_writer = AsyncWriter(self.dm)
+        return self._async_writer
+
+
+    def flush_output(self):
+        """
+        Wait for background writes from save_field_to_hdf5 and
+        save_vector_to_hdf5 (blocking=False) to reach the disk
+        """
+        if self._async_writer is not None:
+            self._async_writer.flush()
@@ -25,6 +25,7 @@ from mpi4py import MPI
 comm = MPI.COMM_WORLD
 
 from . import ConductionND
+from ..tools import sum_duplicates_index, TimeSeriesWriter
 
 class DiffusionND(ConductionND):
     """
@@ -41,12 +42,19 @@ class DiffusionND(ConductionND):
         0.5 = Crank-Nicholson (default, most accurate)
         1.0 = forward Euler
      kwargs   : dict, keyword arguments to pass to KSP method and preconditioner
+        pc_lag = number of changes in dt to reuse the preconditioner (default 0)
         see PETSc documentaion for KSPType and PCType options...
         http://www.mcs.anl.gov/petsc/petsc-current/docs/manualpages/KSP/KSPType.html
         http://www.mcs.anl.gov/petsc/petsc-current/docs/manualpages/PC/PCType.html
     """
     def __init__(self, minCoord, maxCoord, res, theta=0.5, **kwargs):
 
+        # coarse operators must see the time-dependent terms
+        if kwargs.get('pc') == 'mg' and not kwargs.get('mg_galerkin', True):
+            raise ValueError("DiffusionND requires Galerkin multigrid (mg_galerkin=True)")
+
+        pc_lag = kwargs.pop('pc_lag', 0)
+
         super(DiffusionND, self).__init__(minCoord, maxCoord, res, **kwargs)
 
         self.temperature_new = self.create_meshVariable("temperature_new")
@@ -68,6 +76,25 @@ class DiffusionND(ConductionND):
 
         self._ldiag = self.lvec.duplicate()
 
+        # model time and the last timestep size chosen by run_until
+        self.time = 0.0
+        self.dt = None
+
+        # number of changes in dt to reuse the preconditioner
+        self.pc_lag = pc_lag
+
+        # stiffness matrices that are shifted for each dt
+        self._stiffness = None
+        self._stiffness_key = None
+        self._stiffness_id = 0
+        self._mass = None
+        self._mat_dt = None
+        self._mat_dt_key = None
+        self._timestep_ops = {'in_place': True}
+
+        # single-file HDF5 output (see open_timeseries)
+        self.timeseries = None
+
 
     def calculate_dt(self):
         """
@@ -80,21 +107,222 @@ class DiffusionND(ConductionND):
         return dt
 
 
+    def construct_stiffness_matrix(self):
+        """
+        Construct the matrices that do not depend on dt
+         K : coefficient matrix of ConductionND with the Dirichlet rows zeroed
+         L : stencil operator with the Dirichlet rows zeroed
+            (same as K unless the Dirichlet columns are eliminated
+            in symmetric mode)
+
+        These are cached and only rebuilt if the diffusivity, the
+        Dirichlet BCs or the mesh geometry (see refine) have changed
+        on any processor.
+
+        Returns
+        -------
+         K : PETSc Mat
+         L : PETSc Mat
+        """
+        state = (self._geometry_id, self.diffusivity._gdata.stateGet())
+        key = self._stiffness_key
+        cached = key is not None and key[0] == state and np.array_equal(key[1], self.dirichlet_mask)
+
+        # assembly is collective so every processor must rebuild together
+        if not comm.allreduce(not cached, op=MPI.LOR):
+            return self._stiffness
+
+        if self._stiffness is not None:
+            for mat in self._stiffness:
+                self.release_matrix(mat)
+
+        K = self.construct_matrix(in_place=False)
+        L = self._construct_stencil_operator()
+
+        # Dirichlet rows are the identity in K, remove them
+        gmask = self._get_global_mask(self.dirichlet_mask)
+        diag = K.getDiagonal()
+        diag.array[gmask] = 0.0
+        K.setDiagonal(diag)
+        diag.destroy()
+
+        self._stiffness = (K, L)
+        self._stiffness_key = (state, self.dirichlet_mask.copy())
+        self._stiffness_id += 1
+        return self._stiffness
+
+
+    def _construct_stencil_operator(self):
+        """
+        Assemble the stencil with off-diagonals delta*(k_i + k_j) and the
+        negative rowsum on the diagonal. Flux walls need no modification
+        and the rows of Dirichlet nodes are zero.
+        """
+        dirichlet_mask = self.dirichlet_mask
+
+        if self.matrix_free:
+            weights = self._stencil_weights()
+            diag = -weights.sum(axis=0).ravel()
+            diag[dirichlet_mask] = 0.0
+
+            mat = self._get_matrix()
+            mat.getPythonContext().update(weights, ~dirichlet_mask, diag)
+            mat.assemble()
+            return mat
+
+        n = self.n
+        nodes = self.nodes
+        vals = self.vals
+
+        u = self.diffusivity[:].reshape(n)
+        k = np.pad(u, self.width, 'constant', constant_values=0)
+
+        delta = self._stencil_delta
+
+        for i in range(0, self.stencil_width):
+            obj = self._stencil_obj[i]
+            vals[i] = delta[i]*(k[obj] + u).ravel()
+
+        # centre node is the last arm of the stencil
+        vals[-1] = -vals[:-1].sum(axis=0)
+        vals[:,dirichlet_mask] = 0.0
+
+        # keep the pattern of the raw stencil
+        row = np.tile(nodes, self.stencil_width)
+        col = self._stencil_cols.ravel()
+
+        mask, = np.nonzero(col >= 0)
+        order, unique_inds = sum_duplicates_index(row[mask], col[mask])
+        perm = mask[order]
+
+        row = row[perm][unique_inds]
+        col = col[perm][unique_inds]
+        val = np.add.reduceat(vals.ravel()[perm], unique_inds)
+
+        nnz = np.bincount(row, minlength=self.nn)
+        indptr = np.insert(np.cumsum(nnz),0,0).astype(PETSc.IntType)
+
+        mat = self._get_matrix()
+        mat.assemblyBegin()
+        mat.setValuesLocalCSR(indptr, col, val)
+        mat.assemblyEnd()
+        return mat
+
+
+    def _get_mass_matrix(self):
+        """
+        Identity matrix added to the scaled stiffness matrix
+        (the matrix-free operator is shifted instead)
+        """
+        if self._mass is None:
+            diag = self.gvec.duplicate()
+            diag.set(1.0)
+
+            mass = self._initialise_matrix(nnz=(1,0))
+            mass.assemblyBegin()
+            mass.setDiagonal(diag)
+            mass.assemblyEnd()
+
+            diag.destroy()
+            self._mass = mass
+        return self._mass
+
+
+    def _shift_identity(self, X, alpha, mat=None):
+        """
+        Form mat = alpha*X + I
+
+        If mat is given it must have been formed from X before
+        (i.e. share its nonzero pattern) and is overwritten.
+        """
+        if self.matrix_free:
+            if mat is None:
+                mat = self._get_matrix()
+            ctx = X.getPythonContext()
+            mat.getPythonContext().update(ctx.weights, ctx.row_mask, ctx.diag)
+            mat.scale(alpha)
+            mat.shift(1.0)
+            mat.assemble()
+            return mat
+
+        if mat is None:
+            mat = X.duplicate(copy=True)
+        else:
+            X.copy(mat, PETSc.Mat.Structure.SAME_NONZERO_PATTERN)
+        mat.aypx(alpha, self._get_mass_matrix(), PETSc.Mat.Structure.SUBSET_NONZERO_PATTERN)
+        return mat
+
+
+    def _get_global_mask(self, mask):
+        """
+        Map a boolean mask on the local nodes to the owned global nodes
+        """
+        lvec = self.lvec
+        gvec = self.gvec
+        lvec.setArray(mask.astype(float))
+        self.dm.localToGlobal(lvec, gvec)
+        return gvec.array > 0.5
+
+
+    def _form_matrix_dt(self, scale, mat=None):
+        """
+        Form I - scale*K from the stiffness matrix
+        (I + scale*K in symmetric mode where K is already negated)
+        """
+        K, L = self.construct_stiffness_matrix()
+        alpha = scale if self.symmetric else -scale
+        self._lift_scale = (1.0, -scale)
+        return self._shift_identity(K, alpha, mat)
+
+
     def construct_matrix_dt(self, in_place=True, derivative=False, scale=1.0):
         """
         Construct the coefficient matrix
         i.e. matrix A in Ax = b
 
         This extends the ConductionND method by including time-dependence
-        through a scale variable.
+        through a scale variable. The matrix I - scale*K is formed from the
+        cached stiffness matrix K (see construct_stiffness_matrix) with a
+        MatAYPX, so the stencil is only rebuilt if the properties change.
+        In place the matrix is not touched at all if neither scale nor K
+        have changed since the last call.
+        """
+        if derivative:
+            return self._construct_matrix_dt_derivative(in_place, scale)
+
+        if not in_place:
+            return self._form_matrix_dt(scale)
+
+        self.construct_stiffness_matrix()
+
+        key = (self._stiffness_id, scale)
+        if self._mat_dt_key == key:
+            self._lift_scale = (1.0, -scale)
+            return self._mat_dt
+
+        mat = self._mat_dt
+        if mat is not None and self._mat_dt_key[0] != self._stiffness_id:
+            # the nonzero pattern of K may have changed
+            self.release_matrix(mat)
+            mat = None
+
+        self._mat_dt = self._form_matrix_dt(scale, mat)
+        self._mat_dt_key = key
+        return self._mat_dt
+
+
+    def _construct_matrix_dt_derivative(self, in_place=True, scale=1.0):
+        """
+        Derivative of the coefficient matrix built from construct_matrix
         """
         ldiag = self._ldiag
-        mat = self.mat
 
         if scale > 0:
-            mat = super(DiffusionND, self).construct_matrix(in_place, derivative)
+            mat = super(DiffusionND, self).construct_matrix(in_place, derivative=True)
             mat.scale(-scale)
         else:
+            mat = self.mat if in_place else self._get_matrix()
+
             # preallocate identity matrix
             diag = self.gvec.duplicate()
             diag.set(1.0)
@@ -114,85 +342,459 @@ class DiffusionND(ConductionND):
         return mat
 
 
-    def construct_rhs_dt(self, in_place=True, scale=1.0):
+    def construct_rhs_dt(self, in_place=True, scale=1.0, dt=None):
         """
         Construct the right-hand-side vector
         i.e. vector b in Ax = b
 
         This extends the ConductionND method by including time-dependence
-        through a scale variable.
+        through a scale variable. The explicit part of the theta rule is
+        scaled by scale = dt*(1 - theta), while heat sources and fluxes
+        across the walls are constant over the timestep and scaled by dt.
+        Dirichlet nodes keep their current value unless they are set by
+        a Dirichlet wall.
+
+        Arguments
+        ---------
+         in_place : bool, overwrite the rhs of the mesh
+         scale    : float, dt*(1 - theta)
+         dt       : float, timestep size (default is scale)
         """
         if in_place:
             rhs = self.rhs
         else:
             rhs = self.create_meshVariable('rhs')
 
-        if scale > 0:
-            # vectorise stencil similar to matrix construction
-            n = self.n
-            cols = self.cols
-            index = self.index
-            vals = self.vals
-
-            temp  = self.temperature[:].reshape(n)
-            kappa = self.diffusivity[:].reshape(n)
-            k = np.pad(kappa, self.width, 'constant', constant_values=0)
-            T = np.pad(temp,  self.width, 'constant', constant_values=0)
-
-            for i in range(0, self.stencil_width):
-                obj = self.closure[i]
-
-                cols[i] = index[obj].ravel()
-
-                distance = np.linalg.norm(self.coords[cols[i]] - self.coords, axis=1)
-                distance[distance==0] = 1e-12 # protect against dividing by zero
-                delta = scale/distance**2
-
-                vals[i] = delta*(0.5*(k[obj] + kappa)*(T[obj] - temp)).ravel()
-            
-            # zero off-grid coordinates
-            vals[cols < 0] = 0.0
-            vals[-1] = 0.0 # centre point
-            vec = vals.sum(axis=0)
-
-            # add heat sources
-            vec += scale*self.heat_sources[:]
-        else:
-            vec = np.zeros(self.nn)
+        if dt is None:
+            dt = scale
+
+        temp = self.temperature[:]
+        dirichlet_mask = self.dirichlet_mask
+
+        # vectorise stencil similar to matrix construction
+        n = self.n
+        vals = self.vals
+
+        u = temp.reshape(n)
+        kappa = self.diffusivity[:].reshape(n)
+        k = np.pad(kappa, self.width, 'constant', constant_values=0)
+        T = np.pad(u, self.width, 'constant', constant_values=0)
+
+        # cached 1/(2*distance**2) is zero off-grid and at the centre point
+        delta = self._stencil_delta
+
+        for i in range(0, self.stencil_width):
+            obj = self._stencil_obj[i]
+            vals[i] = delta[i]*((k[obj] + kappa)*(T[obj] - u)).ravel()
+
+        vec = scale*vals.sum(axis=0)
+        vec += self._source_dt(dt)
+        vec[dirichlet_mask] = 0.0
 
         # add current temperature
-        vec += self.temperature[:]
+        vec += temp
 
-        # enforce BCs
-        for wall in self.bc:
-            val  = self.bc[wall]['val']
-            flux = self.bc[wall]['flux']
-            mask = self.bc[wall]['mask']
-            if flux:
-                vec[mask] = val
-            else:
-                vec[mask] = val
+        # enforce Dirichlet BCs
+        vec[dirichlet_mask] = self._dirichlet_values()[dirichlet_mask]
 
         rhs[:] = vec
         return rhs
 
 
-    def timestep(self, steps=1, dt=None):
+    def _dirichlet_values(self):
         """
-        Solve a timestep
+        Values of the Dirichlet nodes taken from the walls
+        (nodes off the walls keep their current temperature)
         """
-        if type(dt) == type(None):
-            dt = self.calculate_dt()
+        vals = self.temperature[:].copy()
+
+        for wall in self.bc:
+            if not self.bc[wall]['flux']:
+                vals[self.bc[wall]['mask']] = self.bc[wall]['val']
+
+        return vals
+
+
+    def _source_dt(self, dt):
+        """
+        Heat sources and fluxes across the walls over a timestep
+        i.e. dt*(H - q) where q is summed to the rhs in construct_rhs
+        """
+        vec = self.heat_sources[:].copy()
+
+        for wall in self.bc:
+            if self.bc[wall]['flux']:
+                vec[self.bc[wall]['mask']] -= self.bc[wall]['val']
+
+        vec *= dt
+        vec[self.dirichlet_mask] = 0.0
+        return vec
+
+
+    def construct_explicit_operator(self, scale=1.0):
+        """
+        Construct the explicit part of the theta rule
+        i.e. b = B*T + s in the rhs of each timestep
+
+        where B = I + scale*L is the stencil operator (identity on the
+        Dirichlet rows) and s holds the heat sources and fluxes. For constant
+        properties these do not change between timesteps, so the rhs of
+        construct_rhs_dt reduces to a single MatMultAdd followed by the
+        Dirichlet BCs.
+
+        Matrices returned here can be handed back with release_matrix.
+
+        Returns
+        -------
+         mat : PETSc Mat, operator B
+        """
+        K, L = self.construct_stiffness_matrix()
+        return self._shift_identity(L, scale)
+
+
+    def construct_source_dt(self, dt):
+        """
+        Construct the source term s of the explicit part of the theta rule
+        (see construct_explicit_operator)
+
+        Returns
+        -------
+         source : PETSc Vec
+        """
+        source = self.gvec.duplicate()
+        self.lvec.setArray(self._source_dt(dt))
+        self.dm.localToGlobal(self.lvec, source)
+        return source
+
+
+    def _get_boundary_vectors(self):
+        """
+        Dirichlet values that are enforced on the rhs of each timestep
+        (see construct_rhs_dt) mapped onto the global vector.
+
+        Returns
+        -------
+         mask   : bool array of owned Dirichlet nodes
+         values : values enforced at these nodes
+         lift   : PETSc Vec of Dirichlet columns lifted to the rhs
+            in symmetric mode (None otherwise)
+        """
+        lvals = self._dirichlet_values()
+        gmask = self._get_global_mask(self.dirichlet_mask)
 
+        gvec = self.gvec
+        self.lvec.setArray(lvals)
+        self.dm.localToGlobal(self.lvec, gvec)
+        gvals = gvec.array[gmask]
+
+        lift = None
+        if self.symmetric:
+            # Dirichlet values are constant so the lift is too
+            weights = self._lift_weights[0]
+            sigma, lam = self._lift_scale
+            cols = self._stencil_cols[:-1]
+
+            vec = -sigma*lam*(weights*lvals[cols]).sum(axis=0)
+            vec[self.dirichlet_mask] = 0.0
+
+            lift = gvec.duplicate()
+            self.lvec.setArray(vec)
+            self.dm.localToGlobal(self.lvec, lift)
+
+        return gmask, gvals, lift
+
+
+    def _update_timestep(self, ops, dt, refresh=False):
+        """
+        Update the operators for a timestep of size dt
+
+        The lhs and rhs matrices are only reformed if dt or the stiffness
+        matrix have changed. The preconditioner is reused for up to pc_lag
+        changes in dt before it is rebuilt.
+
+        Arguments
+        ---------
+         ops     : dict of operators, {'in_place': bool} to initialise
+            in_place uses the KSP owned by the mesh,
+            otherwise a new matrix and KSP are created
+         dt      : float, timestep size
+         refresh : bool, rebuild the source term and boundary values
+
+        Returns
+        -------
+         ops : dict of operators to pass to _step and _release_timestep
+        """
         theta = self.theta
         Lscale = dt*theta
         Rscale = dt*(1.0 - theta)
 
-        # construct a constant matrix
-        mat = self.construct_matrix_dt(scale=Lscale)
+        K, L = self.construct_stiffness_matrix()
+        new_stiffness = ops.get('stiffness_id') != self._stiffness_id
+        new_dt = ops.get('dt') != dt
+
+        if new_stiffness or new_dt:
+            in_place = ops['in_place']
+            mat = ops.get('mat')
+            B = ops.get('B')
+            if new_stiffness:
+                if mat is not None and not in_place:
+                    self.release_matrix(mat)
+                if B is not None:
+                    self.release_matrix(B)
+                mat = B = None
+
+            if in_place:
+                mat = self.construct_matrix_dt(scale=Lscale)
+            else:
+                mat = self._form_matrix_dt(Lscale, mat)
+            B = self._shift_identity(L, Rscale, B)
+
+            ksp = ops.get('ksp')
+            if ksp is None:
+                if in_place:
+                    ksp = self.ksp
+                else:
+                    # copy the solver settings of the mesh KSP
+                    rtol, atol, divtol, max_it = self.ksp.getTolerances()
+                    solver = self.ksp.getType()
+                    precon = self.ksp.getPC().getType()
+                    ksp = self._initialise_ksp(mat, atol, rtol, solver=solver, pc=precon)
+
+            # lag the preconditioner across changes in dt
+            age = ops.get('pc_age', 0)
+            reuse = not new_stiffness and age < self.pc_lag
+            ksp.getPC().setReusePreconditioner(reuse)
+
+            ops.update(ksp=ksp, mat=mat, B=B, dt=dt, stiffness_id=self._stiffness_id,
+                       pc_age=age + 1 if reuse else 0)
+            refresh = True
+        else:
+            self._lift_scale = (1.0, -Lscale)
+
+        # the mesh KSP may have been used for another operator
+        ops['ksp'].setOperators(ops['mat'])
+
+        if refresh:
+            for key in ('source', 'lift'):
+                if ops.get(key) is not None:
+                    ops[key].destroy()
+
+            source = self.construct_source_dt(dt)
+            bc_mask, bc_vals, lift = self._get_boundary_vectors()
+
+            ops.update(source=source, bc_mask=bc_mask, bc_vals=bc_vals, lift=lift)
+
+        return ops
+
+
+    def _release_timestep(self, ops):
+        """
+        Free the operators created by _update_timestep
+        """
+        if not ops['in_place']:
+            ops['ksp'].destroy()
+            self.release_matrix(ops['mat'])
+
+        self.release_matrix(ops['B'])
+        ops['source'].destroy()
+        if ops['lift'] is not None:
+            ops['lift'].destroy()
+
 
+    def _step(self, ops, T, res):
+        """
+        Advance the global vector T by one timestep into res
+        (res may be T)
+        """
+        rhs = self.rhs._gdata
+
+        ops['B'].multAdd(T, ops['source'], rhs)
+        rhs.array[ops['bc_mask']] = ops['bc_vals']
+        if ops['lift'] is not None:
+            rhs.axpy(1.0, ops['lift'])
+        ops['ksp'].solve(rhs, res)
+        return res
+
+
+    def timestep(self, steps=1, dt=None):
+        """
+        Solve a timestep
+
+        The lhs and rhs operators are constructed once so each step is a
+        MatMultAdd, boundary conditions and a linear solve on global vectors.
+        """
+        if type(dt) == type(None):
+            dt = self.calculate_dt()
+
+        # properties and BCs may have changed since the last call
+        ops = self._update_timestep(self._timestep_ops, dt, refresh=True)
+
+        T = self.temperature._gdata
         for step in range(steps):
-            rhs = self.construct_rhs_dt(scale=Rscale)
-            T = self.solve(mat, rhs)
+            self._step(ops, T, T)
+
+        self.time += steps*dt
+
+        return self.temperature[:]
+
+
+    def run_until(self, t_end, rtol=1e-3, atol=1e-6, dt=None, output_times=None,
+                  callback=None, dt_min=0.0, dt_max=np.inf, safety=0.9, max_growth=2.0):
+        """
+        Integrate from the current time to t_end with adaptive timesteps
+
+        The local error of each step is estimated by step doubling:
+        a step of dt is compared to two steps of dt/2 and the more accurate
+        solution is kept. A step is accepted if
+            max |T_dt - T_dt/2| / (atol + rtol*|T|) <= 1
+        and dt is grown or shrunk from this error, assuming a local error
+        of order dt^3 for Crank-Nicolson (theta=0.5) and dt^2 otherwise.
+
+        The operators and KSP for dt and dt/2 are kept, so the matrices
+        are only refactored when dt changes (see pc_lag to reuse the
+        preconditioner across changes). Small increases in dt are
+        ignored to avoid refactoring every step.
+
+        Arguments
+        ---------
+         t_end        : float, time to integrate to
+            (cannot be earlier than the current time)
+         rtol         : float, relative error tolerance
+         atol         : float, absolute error tolerance
+         dt           : float, initial timestep size
+            (default is the last dt chosen by run_until or calculate_dt)
+         output_times : list of times to call callback
+            (steps are shortened to land on these exactly)
+         callback     : function called as callback(time, temperature)
+            at every output time and at t_end
+         dt_min       : float, minimum timestep size
+         dt_max       : float, maximum timestep size
+         safety       : float, safety factor on the optimal timestep
+         max_growth   : float, maximum factor to grow dt after a step
+
+        Returns
+        -------
+         temperature : temperature field at t_end
+        """
+        if t_end < self.time:
+            raise ValueError("t_end={} is earlier than the current time {}".format(t_end, self.time))
+
+        if dt is None:
+            dt = self.dt
+        if dt is None:
+            dt = self.calculate_dt()
+        dt = min(max(dt, dt_min), dt_max)
+        self.dt = dt
+
+        if output_times is None:
+            output_times = []
+        eps = 1e-12*max(abs(t_end), 1.0)
+        outputs = sorted([t for t in output_times if self.time + eps < t < t_end - eps])
+        outputs.append(t_end)
+
+        order = 2 if self.theta == 0.5 else 1
+
+        T = self.temperature._gdata
+        T_full = T.duplicate()
+        T_half = T.duplicate()
+        err = np.zeros(1)
+        all_err = np.zeros(1)
+
+        full = {'in_place': False}
+        half = {'in_place': False}
+
+        while outputs:
+            t_out = outputs[0]
+            h = min(dt, t_out - self.time)
+            truncated = h < dt
+
+            # one full step and two half steps
+            self._update_timestep(full, h)
+            self._update_timestep(half, 0.5*h)
+            self._step(full, T, T_full)
+            self._step(half, T, T_half)
+            self._step(half, T_half, T_half)
+
+            # scaled error norm
+            Tn = T.array
+            Th = T_half.array
+            scale = atol + rtol*np.maximum(np.abs(Tn), np.abs(Th))
+            err[0] = np.max(np.abs(Th - T_full.array)/scale) if Tn.size else 0.0
+            comm.Allreduce([err, MPI.DOUBLE], [all_err, MPI.DOUBLE], op=MPI.MAX)
+            error = all_err[0]
+
+            if error > 0:
+                factor = safety*error**(-1.0/(order + 1))
+            else:
+                factor = max_growth
+            factor = min(max_growth, max(0.2, factor))
+
+            if error <= 1.0:
+                T_half.copy(T)
+                self.time += h
+                if abs(self.time - t_out) <= eps:
+                    self.time = t_out
+                    outputs.pop(0)
+                    if callback is not None:
+                        callback(self.time, self.temperature[:])
+
+                # keep dt after short steps and small increases
+                if truncated or factor < 1.2:
+                    factor = 1.0
+            elif h <= dt_min:
+                raise ValueError("error tolerance cannot be met with dt_min={}".format(dt_min))
+            else:
+                # retry with the step that failed
+                dt = h
+
+            dt = min(max(dt*factor, dt_min), dt_max)
+            self.dt = dt
+
+        self._release_timestep(full)
+        self._release_timestep(half)
+        T_full.destroy()
+        T_half.destroy()
+
+        return self.temperature[:]
+
+
+    def open_timeseries(self, filename):
+        """
+        Open a single HDF5 file to append timesteps to with save_timestep
+
+        Fields are stored as extendible datasets /fields/<name> indexed by
+        timestep and an XDMF file is kept up to date alongside it.
+
+        Arguments
+        ---------
+         filename : HDF5 file to write
 
-        return T
+        Returns
+        -------
+         writer : TimeSeriesWriter object
+        """
+        self.close_timeseries()
+        self.timeseries = TimeSeriesWriter(self, filename)
+        return self.timeseries
+
+
+    def save_timestep(self, **kwargs):
+        """
+        Append temperature and any fields passed as keyword arguments
+        at the current model time to the file opened with open_timeseries
+        """
+        if self.timeseries is None:
+            raise ValueError("open a file with open_timeseries before saving timesteps")
+
+        fields = {'temperature': self.temperature}
+        fields.update(kwargs)
+        self.timeseries.write(self.time, **fields)
+
+
+    def close_timeseries(self):
+        """
+        Close the file opened with open_timeseries
+        """
+        if self.timeseries is not None:
+            self.timeseries.close()
+            self.timeseries = None
@@ -0,0 +1,124 @@
+"""
+Copyright 2017 Ben Mather
+
+This file is part of Conduction <https://git.dias.ie/itherc/conduction/>
+
+Conduction is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or any later version.
+
+Conduction is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+try: range = xrange
+except: pass
+
+import numpy as np
+
+
+class StencilMatrix(object):
+    """
+    Python context for a PETSc MatShell that applies the variable-coefficient
+    stencil of ConductionND without storing any matrix indices.
+
+    The operator is A = s * P_N W + diag(d) where
+     W   : off-diagonal stencil weights delta*(k_i + k_j)
+     P_N : projection onto rows that are not Dirichlet nodes
+     s   : scale factor (see scale)
+     d   : diagonal (rowsum of W, overwritten at Dirichlet nodes)
+
+    W is symmetric so the transpose is A^T = s * W P_N + diag(d).
+    Products are evaluated on the local (ghosted) domain of the DMDA
+    after a single ghost exchange.
+
+    Parameters
+    ----------
+     mesh : ConductionND object that owns the stencil geometry
+    """
+    def __init__(self, mesh):
+        self.dm = mesh.dm
+        self.n = mesh.n
+        self.width = mesh.width
+        self.stencil_obj = mesh._stencil_obj[:-1] # ignore centre node
+
+        self.lvec = mesh.lvec.duplicate()
+        self.lres = mesh.lvec.duplicate()
+
+        # padded work array (the border stays zero)
+        self._xpad = np.zeros(self.n + 2*self.width)
+        self._interior = tuple([slice(self.width, -self.width)]*len(self.n))
+
+        self.weights = np.zeros((len(self.stencil_obj),) + tuple(self.n))
+        self.row_mask = np.ones(self.n, dtype=bool)
+        self.diag = np.zeros(mesh.nn)
+        self.factor = 1.0
+
+    def update(self, weights, row_mask, diag):
+        """
+        Update the stencil weights, the rows to apply them to and the diagonal.
+        """
+        self.weights = weights
+        self.row_mask = row_mask.reshape(self.n)
+        self.diag = diag
+        self.factor = 1.0
+
+    def _apply(self, x, row_mask=None):
+        # weighted sum of neighbours for each node
+        xp = self._xpad
+        xp[self._interior] = x.reshape(self.n)
+        if row_mask is not None:
+            xp[self._interior] *= row_mask
+
+        y = np.zeros(self.n)
+        for w, obj in zip(self.weights, self.stencil_obj):
+            y += w*xp[obj]
+        return y
+
+    def _to_global(self, y, Y):
+        self.lres.setArray(y)
+        self.dm.localToGlobal(self.lres, Y)
+
+    def mult(self, mat, X, Y):
+        self.dm.globalToLocal(X, self.lvec)
+        x = self.lvec.array
+        y = self.factor*self._apply(x)*self.row_mask
+        y = y.ravel() + self.diag*x
+        self._to_global(y, Y)
+
+    def multTranspose(self, mat, X, Y):
+        self.dm.globalToLocal(X, self.lvec)
+        x = self.lvec.array
+        y = self.factor*self._apply(x, self.row_mask)
+        y = y.ravel() + self.diag*x
+        self._to_global(y, Y)
+
+    def getDiagonal(self, mat, D):
+        self._to_global(self.diag, D)
+
+    def setDiagonal(self, mat, D, addv):
+        self.dm.globalToLocal(D, self.lvec)
+        if addv:
+            self.diag = self.diag + self.lvec.array
+        else:
+            self.diag = self.lvec.array.copy()
+
+    def scale(self, mat, a):
+        self.factor *= a
+        self.diag = self.diag*a
+
+    def shift(self, mat, a):
+        self.diag = self.diag + a
+
+    def zeroEntries(self, mat):
+        self.weights = np.zeros_like(self.weights)
+        self.diag = np.zeros_like(self.diag)
+        self.factor = 1.0
+
+    def createVecs(self, mat):
+        return self.dm.createGlobalVector(), self.dm.createGlobalVector()
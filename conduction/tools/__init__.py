@@ -19,4 +19,6 @@ along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
 from .generate_xdmf import generateXdmf
 from .generate_timeseries_xdmf import generateTimeseriesXdmf
 from .meshtools import *
-from .perplex_helper import PerplexTable
\ No newline at end of file
+from .perplex_helper import PerplexTable
+from .timeseries_writer import TimeSeriesWriter
+from .async_writer import AsyncWriter
@@ -0,0 +1,265 @@
+"""
+Copyright 2017 Ben Mather
+
+This file is part of Conduction <https://git.dias.ie/itherc/conduction/>
+
+Conduction is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or any later version.
+
+Conduction is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+try: range = xrange
+except: pass
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import atexit
+import threading
+import weakref
+import numpy as np
+from mpi4py import MPI
+
+# writers that are still open when the interpreter exits
+_writers = weakref.WeakSet()
+
+
+class AsyncWriter(object):
+    """
+    Write fields on a DMDA to HDF5 files in the background.
+
+    Rank 0 is the I/O rank. Every other rank copies its owned part of
+    the fields into a buffer and posts a nonblocking send to rank 0, so
+    submit returns straight away. A thread on rank 0 receives the block
+    of one rank at a time and writes it into its slice of each dataset
+    with h5py, so the global arrays are never assembled in memory.
+    Datasets are written in the same layout as the PETSc HDF5 viewer.
+
+    The thread can only receive if MPI was initialised with
+    MPI_THREAD_MULTIPLE. Otherwise rank 0 receives the blocks in submit
+    and the thread only writes them.
+
+    At most maxsize writes may be pending on each rank; submit waits for
+    the oldest one when there are more so memory stays bounded.
+    Pending writes are flushed on exit.
+
+    Parameters
+    ----------
+     dm      : PETSc DMDA the fields live on
+     maxsize : int, number of writes that may be pending
+    """
+    def __init__(self, dm, maxsize=2):
+        # a private communicator keeps our messages apart from the solver
+        self.comm = dm.comm.tompi4py().Dup()
+        self.shape = tuple(dm.getSizes())[::-1]
+        self.maxsize = maxsize
+
+        # owned block of each rank in (z,y,x) order
+        ranges = dm.getRanges()[::-1]
+        self.block = tuple([slice(s, e) for s, e in ranges])
+        self.blocks = self.comm.gather(self.block, root=0)
+
+        # sends (and their buffers) that rank 0 has not received yet
+        self.pending = []
+        self.threaded_recv = MPI.Query_thread() == MPI.THREAD_MULTIPLE
+
+        self.error = None
+        self.queue = None
+        self.thread = None
+
+        if self.comm.rank == 0:
+            # import here because the first import crashes if it happens
+            # in the I/O thread while the interpreter is exiting
+            import h5py
+            self._h5py = h5py
+
+            self.queue = queue.Queue(maxsize)
+            self._start()
+
+        _writers.add(self)
+
+
+    def _start(self):
+        self.thread = threading.Thread(target=self._worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def submit(self, filename, fields):
+        """
+        Queue fields to be written to filename
+
+        Collective: every rank must call submit with the same fields,
+        but only rank 0 waits if its queue is full.
+
+        Arguments
+        ---------
+         filename : HDF5 file to write (created if it does not exist)
+         fields   : list of (name, array, dof) where array is the owned
+            part of a global vector with dof components per node.
+            Arrays are copied so they may be reused immediately.
+        """
+        self._raise_error()
+
+        if fields:
+            data = np.concatenate([np.asarray(arr, dtype=np.float64).ravel() for name, arr, dof in fields])
+        else:
+            data = np.empty(0)
+
+        if self.comm.rank != 0:
+            request = self.comm.Isend([data, MPI.DOUBLE], dest=0)
+            self.pending.append((request, data))
+            self._wait_pending(self.maxsize)
+            return
+
+        header = [(name, dof) for name, arr, dof in fields]
+
+        remote = None
+        if not self.threaded_recv:
+            remote = [self._recv(rank, header) for rank in range(1, self.comm.size)]
+
+        if self.thread is None:
+            self._start()
+        self.queue.put((filename, header, data, remote))
+
+
+    def _wait_pending(self, maxsize):
+        """
+        Free completed sends and wait for the oldest ones until
+        no more than maxsize remain
+        """
+        self.pending = [(request, data) for request, data in self.pending if not request.Test()]
+        while len(self.pending) > maxsize:
+            request, data = self.pending.pop(0)
+            request.Wait()
+
+
+    def _recv(self, rank, header):
+        """
+        Receive the fields of one rank in a single buffer
+        """
+        size = np.prod([s.stop - s.start for s in self.blocks[rank]])
+        data = np.empty(size*sum([dof for name, dof in header]))
+        self.comm.Recv([data, MPI.DOUBLE], source=rank)
+        return data
+
+
+    def _open(self, filename, header):
+        """
+        Open filename and create an empty dataset for each field
+        """
+        import os.path
+
+        mode = 'a' if os.path.isfile(filename) else 'w'
+        f = self._h5py.File(filename, mode)
+        for name, dof in header:
+            shape = self.shape + ((dof,) if dof > 1 else ())
+            if name in f:
+                del f[name]
+            f.create_dataset(name, shape, dtype=np.float64)
+        return f
+
+
+    def _write_block(self, f, header, block, data):
+        """
+        Write the fields of one rank into their slice of each dataset
+        """
+        bshape = tuple([s.stop - s.start for s in block])
+        offset = 0
+        for name, dof in header:
+            shape = bshape + ((dof,) if dof > 1 else ())
+            size = int(np.prod(shape))
+            f[name][block] = data[offset:offset+size].reshape(shape)
+            offset += size
+
+
+    def _write(self, filename, header, data, remote):
+        """
+        Write one submission block by block. After an error the blocks
+        are still received so the sends on the other ranks complete.
+        """
+        f = None
+        if self.error is None:
+            try:
+                f = self._open(filename, header)
+            except Exception as e:
+                self.error = e
+
+        for rank, block in enumerate(self.blocks):
+            if rank > 0:
+                if remote is None:
+                    data = self._recv(rank, header)
+                else:
+                    data = remote[rank-1]
+
+            if f is not None:
+                try:
+                    self._write_block(f, header, block, data)
+                except Exception as e:
+                    self.error = e
+                    f.close()
+                    f = None
+
+        if f is not None:
+            f.close()
+
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+    def flush(self):
+        """
+        Wait until every queued write is on disk (rank 0)
+        or has been received by rank 0 (other ranks)
+        """
+        if self.queue is not None:
+            self.queue.join()
+        self._wait_pending(0)
+        self._raise_error()
+
+
+    def close(self):
+        """
+        Flush pending writes and stop the I/O thread
+        """
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        self._wait_pending(0)
+        self._raise_error()
+
+
+@atexit.register
+def _close_writers():
+    """
+    Flush the pending writes of every open AsyncWriter
+    """
+    for writer in list(_writers):
+        writer.close()
@@ -34,13 +34,25 @@ def sum_duplicates(I, J, V):
     """
     Sum all duplicate entries in the matrix
     """
-    order = np.lexsort((J, I))
+    order, unique_inds = sum_duplicates_index(I, J)
     I, J, V = I[order], J[order], V[order]
+    return I[unique_inds], J[unique_inds], np.add.reduceat(V, unique_inds)
+
+def sum_duplicates_index(I, J):
+    """
+    Find the permutation and reduction indices that sum all duplicate
+    entries in the matrix. These can be reused to sum new values for
+    a fixed sparsity pattern, i.e.
+
+     V = np.add.reduceat(V[order], unique_inds)
+    """
+    order = np.lexsort((J, I))
+    I, J = I[order], J[order]
     unique_mask = ((I[1:] != I[:-1]) |
                    (J[1:] != J[:-1]))
     unique_mask = np.append(True, unique_mask)
     unique_inds, = np.nonzero(unique_mask)
-    return I[unique_mask], J[unique_mask], np.add.reduceat(V, unique_inds)
+    return order, unique_inds
 
 def convert_petscmat_to_scipy(mat):
     from scipy.sparse import csr_matrix
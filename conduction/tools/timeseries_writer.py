@@ -0,0 +1,252 @@
+"""
+Copyright 2017 Ben Mather
+
+This file is part of Conduction <https://git.dias.ie/itherc/conduction/>
+
+Conduction is free software: you can redistribute it and/or modify
+it under the terms of the GNU Lesser General Public License as published by
+the Free Software Foundation, either version 3 of the License, or any later version.
+
+Conduction is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public License
+along with Conduction.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+try: range = xrange
+except: pass
+
+import numpy as np
+from petsc4py import PETSc
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+
+
+class TimeSeriesWriter(object):
+    """
+    Write fields on a mesh to a single HDF5 file as a time series.
+
+    Fields are appended to extendible datasets /fields/<name> with time as
+    the leading dimension through one HDF5 viewer that stays open.
+    The topology is written once and the XDMF file is appended to at
+    every timestep, so the cost of a write does not grow with the
+    number of timesteps.
+
+    Parameters
+    ----------
+     mesh     : ConductionND object the fields live on
+     filename : HDF5 file to write (.h5 is appended if missing)
+               the XDMF file is written alongside with a .xmf extension
+    """
+    def __init__(self, mesh, filename):
+        import os
+
+        filename = str(filename)
+        if not filename.endswith('.h5'):
+            filename += '.h5'
+
+        self.mesh = mesh
+        self.filename = filename
+        self.xdmf_filename = filename[:-3] + '.xmf'
+        self.basename = os.path.basename(filename)
+        self.shape = tuple(mesh.dm.getSizes())[::-1]
+        self.times = []
+        self.step = 0
+
+        self._vecs = {}
+        self._xdmf = None
+        self._xdmf_end = 0
+
+        self._write_topology()
+        comm.Barrier()
+
+        self.viewer = PETSc.Viewer().createHDF5(filename, mode='a', comm=mesh.dm.comm)
+        self.viewer.pushGroup('/fields')
+        self.viewer.pushTimestepping()
+
+        if comm.rank == 0:
+            self._initialise_xdmf()
+
+
+    def _write_topology(self):
+        """
+        Create the HDF5 file and write the bounding box and resolution
+        under the topology group (see ConductionND.save_mesh_to_hdf5)
+        """
+        if comm.rank != 0:
+            return
+
+        import h5py
+
+        mesh = self.mesh
+        extent = mesh.extent.reshape(mesh.dim,-1)
+
+        f = h5py.File(self.filename, 'w')
+        topo = f.create_group('topology')
+        topo.attrs.create('minCoord', extent[:,0][::-1])
+        topo.attrs.create('maxCoord', extent[:,1][::-1])
+        topo.attrs.create('shape', np.array(self.shape))
+        f.close()
+
+
+    def _initialise_xdmf(self):
+        extent = self.mesh.extent.reshape(self.mesh.dim,-1)[::-1]
+        shape = np.array(self.shape)
+        origin = extent[:,0]
+        stride = (extent[:,1] - extent[:,0])/np.maximum(shape - 1, 1)
+
+        dim = len(shape)
+        if dim == 3:
+            topology, geometry = "3DCORECTMesh", "ORIGIN_DXDYDZ"
+        else:
+            topology, geometry = "2DCORECTMesh", "ORIGIN_DXDY"
+
+        self._xdmf = open(self.xdmf_filename, 'w')
+        self._xdmf.write('''<?xml version="1.0" ?>\n\
+<!DOCTYPE Xdmf SYSTEM "Xdmf.dtd" []>\n\
+<Xdmf xmlns:xi="http://www.w3.org/2003/XInclude" Version="2.2">\n\
+  <Domain>\n\
+    <Topology Name="mesh" TopologyType="{1}" Dimensions="{3}"/>\n\
+    <Geometry Name="geometry" GeometryType="{2}">\n\
+      <DataItem Dimensions="{0}" NumberType="Float" Precision="8" Format="XML">{4}</DataItem>\n\
+      <DataItem Dimensions="{0}" NumberType="Float" Precision="8" Format="XML">{5}</DataItem>\n\
+    </Geometry>\n\
+    <Grid Name="TimeSeries" GridType="Collection" CollectionType="Temporal">\n'''.format(\
+            dim, topology, geometry, _to_string(shape), _to_string(origin), _to_string(stride)))
+        self._xdmf_end = self._xdmf.tell()
+        self._write_xdmf_footer()
+
+
+    def _write_xdmf_footer(self):
+        f = self._xdmf
+        f.seek(self._xdmf_end)
+        f.write('''    </Grid>\n  </Domain>\n</Xdmf>\n''')
+        f.truncate()
+        f.flush()
+
+
+    def _write_xdmf_step(self, time, attributes):
+        f = self._xdmf
+        f.seek(self._xdmf_end)
+        f.write('''      <Grid Name="step_{0}" GridType="Uniform">\n\
+        <Time Value="{1!r}"/>\n\
+        <Topology Reference="/Xdmf/Domain/Topology[1]"/>\n\
+        <Geometry Reference="/Xdmf/Domain/Geometry[1]"/>\n'''.format(self.step, float(time)))
+
+        nt = self.step + 1
+        for name, dshape in attributes:
+            arrtype = "Scalar" if len(dshape) == len(self.shape) else "Vector"
+            rank = len(dshape) + 1
+            start = [self.step] + [0]*len(dshape)
+            stride = [1]*rank
+            count = [1] + list(dshape)
+            f.write('''        <Attribute Name="{0}" AttributeType="{1}" Center="Node">\n\
+          <DataItem ItemType="HyperSlab" Dimensions="{2}" Type="HyperSlab">\n\
+            <DataItem Dimensions="3 {3}" Format="XML">{4} {5} {6}</DataItem>\n\
+            <DataItem Dimensions="{7}" NumberType="Float" Precision="8" Format="HDF">{8}:/fields/{0}</DataItem>\n\
+          </DataItem>\n\
+        </Attribute>\n'''.format(name, arrtype, _to_string(dshape), rank,
+                                 _to_string(start), _to_string(stride), _to_string(count),
+                                 _to_string([nt] + list(dshape)), self.basename))
+
+        f.write('''      </Grid>\n''')
+        self._xdmf_end = f.tell()
+        self._write_xdmf_footer()
+
+
+    def _get_vector(self, name, val):
+        """
+        Copy a field into the named global vector that is viewed for it.
+        Tuples of components are written as vector fields.
+        """
+        mesh = self.mesh
+
+        if isinstance(val, (tuple, list)):
+            if name not in self._vecs:
+                vec = mesh.dm.getCoordinates().duplicate()
+                vec.setName(name)
+                self._vecs[name] = vec
+            vec = self._vecs[name]
+            arr = np.array(val).T.ravel()
+            vec.assemblyBegin()
+            vec.setValuesLocal(np.arange(arr.size, dtype=PETSc.IntType), arr)
+            vec.assemblyEnd()
+            return vec, self.shape + (mesh.dim,)
+
+        if name not in self._vecs:
+            vec = mesh.gvec.duplicate()
+            vec.setName(name)
+            self._vecs[name] = vec
+        vec = self._vecs[name]
+
+        if hasattr(val, '_gdata'):
+            val = val._gdata
+        if isinstance(val, PETSc.Vec):
+            val.copy(vec)
+        elif np.size(val) == vec.getLocalSize():
+            vec.setArray(val)
+        else:
+            mesh.lvec.setArray(val)
+            mesh.dm.localToGlobal(mesh.lvec, vec)
+        return vec, self.shape
+
+
+    def write(self, time, **kwargs):
+        """
+        Append fields at a given time
+
+        Arguments
+        ---------
+         time   : float, model time of the fields
+         kwargs : fields to write by name, as local or global arrays,
+            MeshVariables or PETSc global vectors.
+            Tuples of arrays are written as vector fields e.g. Q=(Qx, Qy, Qz)
+            The same fields should be written at every timestep.
+        """
+        self.viewer.setTimestep(self.step)
+
+        attributes = []
+        for name in sorted(kwargs):
+            vec, dshape = self._get_vector(name, kwargs[name])
+            self.viewer.view(obj=vec)
+            attributes.append((name, dshape))
+
+        if comm.rank == 0:
+            self._write_xdmf_step(time, attributes)
+
+        self.times.append(time)
+        self.step += 1
+
+
+    def close(self):
+        """
+        Close the HDF5 viewer and XDMF file
+        """
+        if self.viewer is None:
+            return
+
+        self.viewer.popTimestepping()
+        self.viewer.popGroup()
+        self.viewer.destroy()
+        self.viewer = None
+
+        for vec in self._vecs.values():
+            vec.destroy()
+        self._vecs.clear()
+
+        if self._xdmf is not None:
+            self._xdmf.close()
+            self._xdmf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _to_string(array):
+    return " ".join(["{}".format(i) for i in array])
@@ -0,0 +1,63 @@
+import numpy as np
+from conduction import DiffusionND
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+nx, ny, nz = 12, 12, 12
+
+def setup(**kwargs):
+    mesh = DiffusionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx, ny, nz), **kwargs)
+
+    diffusivity = 1.0 + mesh.coords[:,0]*mesh.coords[:,2]
+    heat_sources = np.ones(mesh.nn)*0.5
+    mesh.update_properties(diffusivity, heat_sources)
+    mesh.temperature[:] = np.zeros(mesh.nn)
+
+    mesh.boundary_condition("minX", 0.3, flux=True)
+    mesh.boundary_condition("minZ", 1.0, flux=False)
+    mesh.boundary_condition("maxZ", 0.0, flux=False)
+    return mesh
+
+# reference solution with many small timesteps
+mesh_fixed = setup()
+dt = mesh_fixed.calculate_dt()
+t_end = 200*dt
+T0 = mesh_fixed.timestep(4000, t_end/4000)
+
+outputs = []
+def callback(time, T):
+    outputs.append(round(float(time/dt), 6))
+
+mesh = setup(pc_lag=5)
+T1 = mesh.run_until(t_end, rtol=1e-3, atol=1e-4, dt=dt, output_times=[10*dt, 100*dt], callback=callback)
+
+error = np.abs(T1 - T0).max()
+print("output times = {}".format(outputs))
+print("final timestep = {:.2f} x calculate_dt".format(mesh.dt/dt))
+print("max error = {:e}".format(error))
+
+# tolerances bound the local error of each step,
+# the global error should be of the same order
+assert outputs == [10.0, 100.0, 200.0], "callback called at {}".format(outputs)
+assert error < 1e-4, "adaptive solution differs from the reference by {:e}".format(error)
+assert mesh.dt > 10*dt, "timestep did not grow from {}".format(dt)
+
+# starting with a timestep that is far too large must shrink it
+mesh = setup(pc_lag=5)
+dt_first = []
+T2 = mesh.run_until(t_end, rtol=1e-3, atol=1e-4, dt=t_end, output_times=[10*dt],
+                    callback=lambda time, T: dt_first.append(mesh.dt))
+
+error = np.abs(T2 - T0).max()
+print("timestep at first output = {:.2f} x calculate_dt".format(dt_first[0]/dt))
+print("max error = {:e}".format(error))
+assert dt_first[0] < 0.1*t_end, "timestep did not shrink from {}".format(t_end)
+assert error < 1e-4, "adaptive solution differs from the reference by {:e}".format(error)
+
+# cannot integrate backwards in time
+try:
+    mesh.run_until(0.5*t_end)
+    raise AssertionError("run_until integrated backwards in time")
+except ValueError:
+    pass
@@ -0,0 +1,68 @@
+
+import threading
+import numpy as np
+import h5py
+from conduction import ConductionND
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+nx, ny, nz = 10, 9, 8
+
+mesh = ConductionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx, ny, nz))
+
+x, y, z = mesh.coords.T
+filename = 'async_output_test.h5'
+
+# several fields in one background write must not share a buffer
+mesh.save_field_to_hdf5(filename, A=x, B=-np.ones(mesh.nn), blocking=False)
+mesh.save_vector_to_hdf5(filename, Q=(x, y, z), R=(z, y, x), blocking=False)
+mesh.flush_output()
+
+if comm.rank == 0:
+    zz, yy, xx = np.meshgrid(np.linspace(minZ, maxZ, nz),
+                             np.linspace(minY, maxY, ny),
+                             np.linspace(minX, maxX, nx), indexing='ij')
+
+    f = h5py.File(filename, 'r')
+    for name, expected in [('A', xx), ('B', -np.ones_like(xx)),
+                           ('Q', np.stack([xx, yy, zz], axis=-1)),
+                           ('R', np.stack([zz, yy, xx], axis=-1))]:
+        error = np.abs(f[name][:] - expected).max()
+        print("{} max error = {:e}".format(name, error))
+        assert error < 1e-12, "field {} was not written correctly".format(name)
+    f.close()
+
+# the solver must not wait for a write that is still queued
+mesh.update_properties(np.ones(mesh.nn), np.zeros(mesh.nn))
+mesh.boundary_condition("maxZ", 0.0, flux=False)
+mesh.boundary_condition("minZ", 1.0, flux=False)
+
+writer = mesh._get_async_writer()
+if comm.rank == 0:
+    release = threading.Event()
+    write = writer._write
+    def held_write(*args):
+        release.wait(60)
+        write(*args)
+    writer._write = held_write
+
+filename = 'async_output_held.h5'
+mesh.save_field_to_hdf5(filename, C=z, blocking=False)
+sol = mesh.solve()
+
+if comm.rank == 0:
+    # still queued after the solve
+    queued = writer.queue.unfinished_tasks
+    release.set()
+    assert queued == 1, "solve waited for the background write"
+mesh.flush_output()
+
+if comm.rank == 0:
+    f = h5py.File(filename, 'r')
+    error = np.abs(f['C'][:] - zz).max()
+    print("C max error = {:e}".format(error))
+    assert error < 1e-12, "field C was not written correctly"
+    f.close()
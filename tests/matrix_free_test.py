@@ -0,0 +1,75 @@
+
+import numpy as np
+from conduction import ConductionND
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+nx, ny, nz = 20, 20, 20
+
+def setup(**kwargs):
+    mesh = ConductionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx, ny, nz), **kwargs)
+
+    diffusivity = 1.0 + mesh.coords[:,0]*mesh.coords[:,2]
+    heat_sources = np.ones(mesh.nn)*1e-6
+    mesh.update_properties(diffusivity, heat_sources)
+
+    mesh.boundary_condition("maxZ", 0.0, flux=False)
+    mesh.boundary_condition("minZ", 1.0, flux=True)
+    return mesh
+
+# assembled and matrix-free operators should agree
+mesh_aij = setup()
+mesh_mf  = setup(matrix_free=True)
+
+A = mesh_aij.construct_matrix()
+M = mesh_mf.construct_matrix()
+
+x = mesh_aij.gvec.duplicate()
+x.setRandom()
+y0, y1 = x.duplicate(), x.duplicate()
+
+# errors are relative to the assembled operator
+A.mult(x, y0)
+M.mult(x, y1)
+error = (y1 - y0).norm()/y0.norm()
+print("mult error = {:e}".format(error))
+assert error < 1e-12
+
+A.multTranspose(x, y0)
+M.multTranspose(x, y1)
+error = (y1 - y0).norm()/y0.norm()
+print("multTranspose error = {:e}".format(error))
+assert error < 1e-12
+
+d0 = A.getDiagonal()
+error = (M.getDiagonal() - d0).norm()/d0.norm()
+print("diagonal error = {:e}".format(error))
+assert error < 1e-12
+
+# both solves stop at the absolute tolerance of the KSP
+T0 = mesh_aij.solve()
+T1 = mesh_mf.solve()
+error = np.abs(T1 - T0).max()
+print("solution error = {:e}".format(error))
+assert error < 1e-6
+
+# Picard iterations work with the matrix-free operator but Newton's
+# method and its adjoint need the assembled Jacobian
+k_fn = lambda T: 1.0 + 0.5*T
+dk_dT_fn = lambda T: 0.5*np.ones_like(T)
+
+T0 = mesh_aij.solve_nonlinear(k_fn, method='picard', tolerance=1e-8)
+T1 = mesh_mf.solve_nonlinear(k_fn, method='picard', tolerance=1e-8)
+error = np.abs(T1 - T0).max()
+print("nonlinear solution error = {:e}".format(error))
+assert error < 1e-6
+
+for fn, args in [(mesh_mf.solve_nonlinear, (k_fn, dk_dT_fn)),
+                 (mesh_mf.solve_nonlinear_ad, (T1, np.ones_like(T1), k_fn, dk_dT_fn))]:
+    try:
+        fn(*args)
+    except ValueError as e:
+        print("{}: {}".format(fn.__name__, e))
+    else:
+        raise AssertionError("{} should reject matrix_free=True".format(fn.__name__))
@@ -0,0 +1,49 @@
+
+import numpy as np
+from conduction import ConductionND
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+resolutions = [17, 33, 65]
+
+def setup(n, **kwargs):
+    mesh = ConductionND((minX, minY, minZ), (maxX, maxY, maxZ), (n, n, n), rtol=1e-8, **kwargs)
+
+    diffusivity = np.ones(mesh.nn)
+    diffusivity[mesh.coords[:,2] > 0.5] = 5.0
+    heat_sources = np.ones(mesh.nn)*1e-6
+    mesh.update_properties(diffusivity, heat_sources)
+
+    mesh.boundary_condition("maxZ", 0.0, flux=False)
+    mesh.boundary_condition("minZ", 1.0, flux=True)
+    return mesh
+
+variants = [("mg galerkin", {'pc': 'mg'}),
+            ("mg rediscretised", {'pc': 'mg', 'mg_galerkin': False})]
+
+# unpreconditioned reference on the coarsest grid
+T = dict()
+T["gmres"] = setup(resolutions[0]).solve()
+
+its = dict()
+for n in resolutions:
+    for name, kwargs in variants:
+        mesh = setup(n, **kwargs)
+        sol = mesh.solve()
+        its[name, n] = mesh.ksp.getIterationNumber()
+        print("{:20} nx = {:3} iterations = {}".format(name, n, its[name, n]))
+
+        if n == resolutions[0]:
+            T[name] = sol
+
+for name in T:
+    print("{:20} max error  = {:e}".format(name, np.abs(T[name] - T["gmres"]).max()))
+
+# multigrid should converge in O(10) iterations regardless of the
+# resolution or the number of processors
+for name, kwargs in variants:
+    counts = [its[name, n] for n in resolutions]
+    assert max(counts) <= 15, "{} took {} iterations".format(name, counts)
+    assert max(counts) - min(counts) <= 3, "{} iterations grow with resolution {}".format(name, counts)
+    assert np.abs(T[name] - T["gmres"]).max() < 1e-6
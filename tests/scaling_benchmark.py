@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 from petsc4py import PETSc
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
-from conduction import Conduction3D
+from conduction import ConductionND
 from time import clock
 
 try: range=xrange
@@ -34,10 +34,10 @@ minY, maxY = 1.0, 2.0
 minZ, maxZ = 3.0, 4.0
 nx, ny, nz = 100, 100, 1000
 
-ode = Conduction3D((minX, minY, minZ), (maxX, maxY, maxZ), (nx,ny,nz))
+ode = ConductionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx,ny,nz))
 
 
-conductivity = np.ones(ode.nx*ode.ny*ode.nz)
+conductivity = np.ones(ode.nn)
 heat_sources = np.ones_like(conductivity)
 ode.update_properties(conductivity, heat_sources)
 
@@ -60,7 +60,7 @@ ksp.setFromOptions()
 
 def solve(ksp, rhs, res):
     res.set(0.0)
-    ksp.solve(rhs, res)
+    ksp.solve(rhs._gdata, res)
 
 
 
@@ -0,0 +1,60 @@
+
+import numpy as np
+from conduction import ConductionND
+from petsc4py import PETSc
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+nx, ny, nz = 20, 20, 20
+
+def setup(**kwargs):
+    mesh = ConductionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx, ny, nz), **kwargs)
+
+    diffusivity = 1.0 + mesh.coords[:,0]*mesh.coords[:,2]
+    heat_sources = np.ones(mesh.nn)*1e-6
+    mesh.update_properties(diffusivity, heat_sources)
+
+    mesh.boundary_condition("maxZ", 0.0, flux=False)
+    mesh.boundary_condition("minZ", 1.0, flux=False)
+    mesh.boundary_condition("minX", 0.1, flux=True)
+    return mesh
+
+mesh_gmres = setup()
+mesh_cg = setup(symmetric=True)
+
+# explicit zeros in the Dirichlet columns break structural symmetry
+# so compare the entries instead of calling isSymmetric
+def asymmetry(A):
+    AT = A.transpose(PETSc.Mat())
+    AT.axpy(-1.0, A, structure=PETSc.Mat.Structure.DIFFERENT)
+    norm = AT.norm()
+    AT.destroy()
+    return norm
+
+asym_cg = asymmetry(mesh_cg.construct_matrix())
+asym_gmres = asymmetry(mesh_gmres.construct_matrix())
+print("asymmetry = {:e} (nonsymmetric assembly {:e})".format(asym_cg, asym_gmres))
+assert asym_cg < 1e-12*asym_gmres
+
+T0 = mesh_gmres.solve()
+T1 = mesh_cg.solve()
+print("{} iterations = {}".format(mesh_cg.ksp.getType(), mesh_cg.ksp.getIterationNumber()))
+print("solution error = {:e}".format(np.abs(T1 - T0).max()))
+
+# transpose solve against the nonsymmetric matrix
+rhs = mesh_gmres.create_meshVariable('b')
+rhs[:] = np.random.random(mesh_gmres.nn)
+
+x0 = mesh_gmres.gvec.duplicate()
+x1 = mesh_gmres.gvec.duplicate()
+mesh_gmres._solve(mesh_gmres.ksp, rhs, x0, transpose=True)
+mesh_cg._solve(mesh_cg.ksp, rhs, x1, transpose=True)
+print("transpose error = {:e}".format((x1 - x0).norm()))
+
+# both solves stop at a relative residual of rtol, so the error is bounded
+# by rtol times the condition number of the (preconditioned) matrix
+rtol = mesh_gmres.ksp.getTolerances()[0]
+rel_error = (x1 - x0).norm()/x0.norm()
+print("relative transpose error = {:e} (rtol = {:e})".format(rel_error, rtol))
+assert rel_error < 1e3*rtol, "transpose solves differ by {:e}".format(rel_error)
@@ -0,0 +1,73 @@
+
+import numpy as np
+from conduction import DiffusionND
+from petsc4py import PETSc
+from mpi4py import MPI
+comm = MPI.COMM_WORLD
+
+minX, maxX = 0.0, 1.0
+minY, maxY = 0.0, 1.0
+minZ, maxZ = 0.0, 1.0
+nx, ny, nz = 10, 9, 8
+nsteps = 4
+
+filename = 'timeseries_test.h5'
+
+
+def write_timeseries():
+    mesh = DiffusionND((minX, minY, minZ), (maxX, maxY, maxZ), (nx, ny, nz))
+    mesh.update_properties(np.ones(mesh.nn), np.zeros(mesh.nn))
+    mesh.boundary_condition("maxZ", 0.0, flux=False)
+    mesh.boundary_condition("minZ", 1.0, flux=False)
+    mesh.temperature[:] = np.zeros(mesh.nn)
+
+    x, y, z = mesh.coords.T
+    dt = mesh.calculate_dt()
+
+    times = []
+    mesh.open_timeseries(filename)
+    for step in range(0, nsteps):
+        mesh.timestep(2, dt)
+        mesh.save_timestep(A=x + mesh.time, Q=(x, y, z))
+        times.append(mesh.time)
+    mesh.close_timeseries()
+    return times
+
+
+def check_timeseries(times):
+    import h5py
+    import xml.etree.ElementTree as ET
+
+    zz, yy, xx = np.meshgrid(np.linspace(minZ, maxZ, nz),
+                             np.linspace(minY, maxY, ny),
+                             np.linspace(minX, maxX, nx), indexing='ij')
+
+    f = h5py.File(filename, 'r')
+    for name in ['temperature', 'A', 'Q']:
+        print("{:12} shape = {}".format(name, f['fields'][name].shape))
+
+    # time is the leading dimension of each dataset
+    assert f['fields/temperature'].shape == (nsteps, nz, ny, nx)
+    assert f['fields/Q'].shape == (nsteps, nz, ny, nx, 3)
+
+    for i, time in enumerate(times):
+        error = np.abs(f['fields/A'][i] - (xx + time)).max()
+        assert error < 1e-12, "step {} of A was not written correctly".format(i)
+
+    error = np.abs(f['fields/Q'][-1] - np.stack([xx, yy, zz], axis=-1)).max()
+    assert error < 1e-12, "Q was not written correctly"
+    f.close()
+
+    # every timestep is listed in the XDMF file
+    root = ET.parse(filename[:-3] + '.xmf').getroot()
+    xdmf_times = [float(t.get('Value')) for t in root.iter('Time')]
+    print("xdmf times = {}".format(xdmf_times))
+    assert np.allclose(xdmf_times, times, rtol=1e-12, atol=0.0)
+
+
+if PETSc.Sys.hasExternalPackage('hdf5'):
+    times = write_timeseries()
+    if comm.rank == 0:
+        check_timeseries(times)
+elif comm.rank == 0:
+    print("PETSc was not built with HDF5, skipping")